@@ -0,0 +1,94 @@
+# Measures what @cache.cache costs per call on a cache hit.
+# Run from the repository root: python -m benchmarks.cache_overhead
+
+import asyncio
+import sys
+import timeit
+
+from utilities import cache
+
+
+class User:
+    def __init__(self, user_id):
+        self.id = user_id
+
+    def plain(self, tracks=99, time_range="short_term"):
+        return tracks
+
+    @cache.cache(strategy=cache.Strategy.timed)
+    def timed(self, tracks=99, time_range="short_term"):
+        return tracks
+
+    @cache.cache(strategy=cache.Strategy.internal)
+    def internal(self, tracks=99, time_range="short_term"):
+        return tracks
+
+    @cache.cache(strategy=cache.Strategy.timed)
+    def features(self, track_ids):
+        return track_ids
+
+    @cache.cache(strategy=cache.Strategy.timed)
+    async def top_tracks(self, tracks=99, time_range="short_term"):
+        return tracks
+
+    async def plain_top_tracks(self, tracks=99, time_range="short_term"):
+        return tracks
+
+
+def _per_call(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return best / number * 1e9  # ns
+
+
+def _per_await(coro_func, number):
+    async def run():
+        for _ in range(number):
+            await coro_func()
+
+    def timed():
+        asyncio.run(run())
+
+    return _per_call(timed, 1) / number
+
+
+def main(number=200_000):
+    user = User("x7vjqlqi759vsiemiqh9ekdoa")
+    track_ids = [f"{i:022d}" for i in range(100)]
+
+    # Warm every cache so only hits are measured
+    user.timed(time_range="long_term")
+    user.internal(time_range="long_term")
+    user.features(track_ids)
+    asyncio.run(user.top_tracks(time_range="long_term"))
+
+    results = {
+        "undecorated call": _per_call(
+            lambda: user.plain(time_range="long_term"), number
+        ),
+        "timed hit (user, kwarg)": _per_call(
+            lambda: user.timed(time_range="long_term"), number
+        ),
+        "internal hit (user, kwarg)": _per_call(
+            lambda: user.internal(time_range="long_term"), number
+        ),
+        "timed hit (user, 100 ids)": _per_call(
+            lambda: user.features(track_ids), number // 4
+        ),
+        "key only (user, 100 ids)": _per_call(
+            lambda: User.features.get_key(user, track_ids), number // 4
+        ),
+        "undecorated await": _per_await(
+            lambda: user.plain_top_tracks(time_range="long_term"), number // 4
+        ),
+        "async timed hit (user, kwarg)": _per_await(
+            lambda: user.top_tracks(time_range="long_term"), number // 4
+        ),
+    }
+
+    width = max(map(len, results))
+    for name, ns in results.items():
+        print(f"{name:<{width}}  {ns:>9.0f} ns/call")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,622 @@
+# Local stand-in for the Spotify Web API, for load and latency testing.
+# Point config.SPOTIFY.api_url and accounts_url at it, then run from the
+# repository root: python -m benchmarks.fake_spotify --help
+#
+# Libraries are generated from the user id, so every run sees the same data.
+# Any id is accepted, made up ones map onto the synthetic catalog.
+
+import argparse
+import asyncio
+import random
+import time
+import zlib
+
+from collections import Counter
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+from utilities import codec
+
+ACCESS_PREFIX = "fake-access:"
+REFRESH_PREFIX = "fake-refresh:"
+GENRES = ["pop", "rock", "indie", "hip-hop", "jazz", "house", "metal", "folk"]
+ERRORS = {
+    400: web.HTTPBadRequest,
+    401: web.HTTPUnauthorized,
+    404: web.HTTPNotFound,
+}
+
+
+def _index(item_id, size):
+    """Catalog position of an id, ours or made up"""
+    if item_id[1:].isdigit():
+        return int(item_id[1:]) % size
+    return zlib.crc32(item_id.encode()) % size
+
+
+def _id(kind, index):
+    return f"{kind}{index:021d}"  # 22 characters like Spotify's
+
+
+def _images(seed):
+    return [
+        {"height": s, "width": s, "url": f"https://i.scdn.co/image/{seed}-{s}"}
+        for s in (640, 300, 64)
+    ]
+
+
+def _urls(kind, item_id):
+    return {"spotify": f"https://open.spotify.com/{kind}/{item_id}"}
+
+
+class FakeSpotify:
+    def __init__(
+        self,
+        *,
+        tracks=50000,
+        liked=500,
+        top=99,
+        playlists=20,
+        playlist_tracks=100,
+        saved_albums=50,
+        latency=0.05,
+        jitter=0.02,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        retry_after=1,
+        seed=0,
+    ):
+        self.tracks = tracks
+        self.albums = max(1, tracks // 10)
+        self.artists = max(1, tracks // 20)
+        self.liked = liked
+        self.top = top
+        self.playlists = playlists
+        self.playlist_tracks = playlist_tracks
+        self.saved_albums = saved_albums
+
+        self.latency = latency  # Seconds added to every response
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate  # Chance of a 429
+        self.error_rate = error_rate  # Chance of a 503
+        self.retry_after = retry_after
+
+        self.random = random.Random(seed)
+        self.requests = Counter()  # "METHOD route" -> count
+        self.statuses = Counter()
+
+    # Catalog, every object is generated from its id
+
+    def artist(self, artist_id):
+        i = _index(artist_id, self.artists)
+        return {
+            "external_urls": _urls("artist", artist_id),
+            "followers": {"href": None, "total": i * 37 % 1000000},
+            "genres": [GENRES[i % len(GENRES)], GENRES[i * 3 % len(GENRES)]],
+            "id": artist_id,
+            "images": _images(artist_id),
+            "name": f"Artist {i}",
+            "popularity": i % 100,
+            "type": "artist",
+            "uri": "spotify:artist:" + artist_id,
+        }
+
+    def simple_artist(self, artist_id):
+        artist = self.artist(artist_id)
+        return {k: artist[k] for k in ("external_urls", "id", "name", "type", "uri")}
+
+    def album(self, album_id, *, full=False):
+        i = _index(album_id, self.albums)
+        data = {
+            "album_type": "album",
+            "artists": [self.simple_artist(_id("r", i % self.artists))],
+            "external_urls": _urls("album", album_id),
+            "id": album_id,
+            "images": _images(album_id),
+            "name": f"Album {i}",
+            "release_date": f"{1960 + i % 63}-{i % 12 + 1:02d}-{i % 28 + 1:02d}",
+            "release_date_precision": "day",
+            "total_tracks": 10,
+            "type": "album",
+            "uri": "spotify:album:" + album_id,
+        }
+        if full:
+            items = [self.simple_track(_id("t", i * 10 + n)) for n in range(10)]
+            path = f"albums/{album_id}/tracks"
+            data["tracks"] = self.page(path, items, 50, 0, len(items))
+            data["genres"] = []
+            data["popularity"] = i % 100
+        return data
+
+    def simple_track(self, track_id):
+        i = _index(track_id, self.tracks)
+        return {
+            "artists": [
+                self.simple_artist(_id("r", i % self.artists)),
+                self.simple_artist(_id("r", (i * 7 + 1) % self.artists)),
+            ],
+            "disc_number": 1,
+            "duration_ms": 120000 + i * 7919 % 240000,
+            "explicit": i % 5 == 0,
+            "external_urls": _urls("track", track_id),
+            "id": track_id,
+            "is_local": False,
+            "name": f"Track {i}",
+            "preview_url": f"https://p.scdn.co/mp3-preview/{track_id}",
+            "track_number": i % 10 + 1,
+            "type": "track",
+            "uri": "spotify:track:" + track_id,
+        }
+
+    def track(self, track_id):
+        i = _index(track_id, self.tracks)
+        data = self.simple_track(track_id)
+        data["album"] = self.album(_id("a", i // 10 % self.albums))
+        data["popularity"] = i % 100
+        return data
+
+    def features(self, track_id):
+        i = _index(track_id, self.tracks)
+        r = random.Random(i)
+        return {
+            "acousticness": r.random(),
+            "analysis_url": f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+            "danceability": r.random(),
+            "duration_ms": 120000 + i * 7919 % 240000,
+            "energy": r.random(),
+            "id": track_id,
+            "instrumentalness": r.random() / 4,
+            "key": r.randrange(12),
+            "liveness": r.random() / 2,
+            "loudness": -r.uniform(2, 20),
+            "mode": r.randrange(2),
+            "speechiness": r.random() / 3,
+            "tempo": r.uniform(60, 180),
+            "time_signature": 4,
+            "track_href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "type": "audio_features",
+            "uri": "spotify:track:" + track_id,
+            "valence": r.random(),
+        }
+
+    def user(self, user_id):
+        return {
+            "country": "US",
+            "display_name": f"User {user_id}",
+            "external_urls": _urls("user", user_id),
+            "followers": {"href": None, "total": len(user_id)},
+            "id": user_id,
+            "images": _images(user_id),
+            "product": "premium",
+            "type": "user",
+            "uri": "spotify:user:" + user_id,
+        }
+
+    def playlist(self, playlist_id, *, full=False):
+        i = _index(playlist_id, 1 << 30)
+        owner = self.user(f"owner{i % 50}")
+        data = {
+            "collaborative": i % 7 == 0,
+            "description": f"Synthetic playlist {i}",
+            "external_urls": _urls("playlist", playlist_id),
+            "followers": {"href": None, "total": i % 500},
+            "id": playlist_id,
+            "images": _images(playlist_id),
+            "name": f"Playlist {i}",
+            "owner": {k: owner[k] for k in ("display_name", "external_urls", "id")},
+            "public": i % 3 != 0,
+            "snapshot_id": str(i),
+            "tracks": {"href": None, "total": self.playlist_tracks},
+            "type": "playlist",
+            "uri": "spotify:playlist:" + playlist_id,
+        }
+        if full:
+            data["tracks"] = self.playlist_items(playlist_id, 100, 0)
+        return data
+
+    def playlist_items(self, playlist_id, limit, offset):
+        indices = self.sample(playlist_id, self.tracks, self.playlist_tracks)
+        items = [
+            {"added_at": "2022-01-01T00:00:00Z", "track": self.track(_id("t", i))}
+            for i in indices[offset : offset + limit]
+        ]
+        return self.page(f"playlists/{playlist_id}/tracks", items, limit, offset)
+
+    def sample(self, seed, population, k):
+        """The same k catalog positions for the same seed"""
+        return random.Random(seed).sample(range(population), min(k, population))
+
+    def page(self, path, items, limit, offset, total=None):
+        total = len(items) if total is None else total
+        href = lambda offset: "%s%s?%s" % (
+            "https://api.spotify.com/v1/",
+            path,
+            urlencode({"limit": limit, "offset": offset}),
+        )
+        return {
+            "href": href(offset),
+            "items": items,
+            "limit": limit,
+            "next": href(offset + limit) if offset + limit < total else None,
+            "offset": offset,
+            "previous": href(max(0, offset - limit)) if offset else None,
+            "total": total,
+        }
+
+    # Request helpers
+
+    def paging(self, request, max_limit=50):
+        try:
+            limit = int(request.query.get("limit", 20))
+            offset = int(request.query.get("offset", 0))
+        except ValueError:
+            raise self.error(400, "Invalid limit or offset")
+        if not 0 < limit <= max_limit or offset < 0:
+            raise self.error(400, "Invalid limit")
+        return limit, offset
+
+    def ids(self, request, max_ids):
+        ids = [i for i in request.query.get("ids", "").split(",") if i]
+        if not ids or len(ids) > max_ids:
+            raise self.error(400, "Invalid ids")
+        return ids
+
+    def error(self, status, message):
+        body = codec.dumps({"error": {"status": status, "message": message}})
+        return ERRORS[status](text=body, content_type="application/json")
+
+    def user_id(self, request):
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith("Bearer " + ACCESS_PREFIX):
+            raise self.error(401, "Invalid access token")
+        return auth[len("Bearer " + ACCESS_PREFIX) :]
+
+    def paged_library(self, request, seed, population, size, make_item, path):
+        limit, offset = self.paging(request)
+        indices = self.sample(seed, population, size)
+        items = [make_item(i) for i in indices[offset : offset + limit]]
+        return self.page(path, items, limit, offset, len(indices))
+
+    # Accounts service
+
+    async def authorize(self, request):
+        """Logs in as ?login=<user id> without asking, the code is the user id"""
+        params = {
+            "code": request.query.get("login", "fakeuser"),
+            "state": request.query.get("state", ""),
+        }
+        raise web.HTTPFound(request.query["redirect_uri"] + "?" + urlencode(params))
+
+    async def token(self, request):
+        form = await request.post()
+        grant = form.get("grant_type")
+        if grant == "client_credentials":
+            user_id = "client"
+        elif grant == "authorization_code":
+            user_id = form.get("code", "fakeuser")
+        elif grant == "refresh_token":
+            user_id = form.get("refresh_token", "")[len(REFRESH_PREFIX) :]
+        else:
+            raise self.error(400, "unsupported_grant_type")
+
+        data = {
+            "access_token": ACCESS_PREFIX + user_id,
+            "token_type": "Bearer",
+            "expires_in": 3600,
+            "scope": "",
+        }
+        if grant != "client_credentials":
+            data["refresh_token"] = REFRESH_PREFIX + user_id
+        return data
+
+    # Current user
+
+    async def me(self, request):
+        return self.user(self.user_id(request))
+
+    async def get_top(self, request):
+        user_id = self.user_id(request)
+        kind = request.match_info["kind"]
+        seed = f"{user_id}:{kind}:{request.query.get('time_range', 'medium_term')}"
+        if kind == "tracks":
+            make, population = lambda i: self.track(_id("t", i)), self.tracks
+        else:
+            make, population = lambda i: self.artist(_id("r", i)), self.artists
+        path = f"me/top/{kind}"
+        return self.paged_library(request, seed, population, self.top, make, path)
+
+    async def get_liked(self, request):
+        make = lambda i: {
+            "added_at": "2022-01-01T00:00:00Z",
+            "track": self.track(_id("t", i)),
+        }
+        seed = self.user_id(request) + ":liked"
+        return self.paged_library(
+            request, seed, self.tracks, self.liked, make, "me/tracks"
+        )
+
+    async def get_saved_albums(self, request):
+        make = lambda i: {
+            "added_at": "2022-01-01T00:00:00Z",
+            "album": self.album(_id("a", i), full=True),
+        }
+        seed = self.user_id(request) + ":albums"
+        return self.paged_library(
+            request, seed, self.albums, self.saved_albums, make, "me/albums"
+        )
+
+    async def my_playlists(self, request):
+        return self.user_playlists(request, self.user_id(request))
+
+    async def other_playlists(self, request):
+        self.user_id(request)
+        return self.user_playlists(request, request.match_info["user_id"])
+
+    def user_playlists(self, request, user_id):
+        make = lambda i: self.playlist(_id("p", i))
+        return self.paged_library(
+            request,
+            user_id + ":playlists",
+            1 << 30,
+            self.playlists,
+            make,
+            f"users/{user_id}/playlists",
+        )
+
+    async def recently_played(self, request):
+        limit, _ = self.paging(request)
+        seed = f"{self.user_id(request)}:recent:{int(time.time()) // 300}"
+        items = [
+            {"played_at": "2022-01-01T00:00:00Z", "track": self.track(_id("t", i))}
+            for i in self.sample(seed, self.tracks, limit)
+        ]
+        data = self.page("me/player/recently-played", items, limit, 0)
+        data["cursors"] = {"after": "0", "before": "0"}
+        return data
+
+    async def currently_playing(self, request):
+        user_id = self.user_id(request)
+        playing = int(time.time()) // 180  # A new track every three minutes
+        if zlib.crc32(f"{user_id}:{playing}".encode()) % 4 == 0:
+            return None  # Nothing playing, 204
+        (i,) = self.sample(f"{user_id}:{playing}", self.tracks, 1)
+        return {
+            "currently_playing_type": "track",
+            "is_playing": True,
+            "item": self.track(_id("t", i)),
+            "progress_ms": int(time.time()) % 180 * 1000,
+            "timestamp": int(time.time() * 1000),
+        }
+
+    # Catalog
+
+    async def get_track(self, request):
+        self.user_id(request)
+        return self.track(request.match_info["id"])
+
+    async def get_tracks(self, request):
+        self.user_id(request)
+        return {"tracks": [self.track(i) for i in self.ids(request, 50)]}
+
+    async def get_features(self, request):
+        self.user_id(request)
+        return self.features(request.match_info["id"])
+
+    async def get_many_features(self, request):
+        self.user_id(request)
+        return {"audio_features": [self.features(i) for i in self.ids(request, 100)]}
+
+    async def get_album(self, request):
+        self.user_id(request)
+        return self.album(request.match_info["id"], full=True)
+
+    async def get_albums(self, request):
+        self.user_id(request)
+        ids = self.ids(request, 20)
+        return {"albums": [self.album(i, full=True) for i in ids]}
+
+    async def get_album_tracks(self, request):
+        self.user_id(request)
+        limit, offset = self.paging(request)
+        album = self.album(request.match_info["id"], full=True)
+        items = album["tracks"]["items"]
+        path = f"albums/{album['id']}/tracks"
+        return self.page(path, items[offset : offset + limit], limit, offset, 10)
+
+    async def get_artist(self, request):
+        self.user_id(request)
+        return self.artist(request.match_info["id"])
+
+    async def get_artists(self, request):
+        self.user_id(request)
+        return {"artists": [self.artist(i) for i in self.ids(request, 50)]}
+
+    async def get_artist_top_tracks(self, request):
+        self.user_id(request)
+        artist_id = request.match_info["id"]
+        indices = self.sample(artist_id + ":top", self.tracks, 10)
+        return {"tracks": [self.track(_id("t", i)) for i in indices]}
+
+    async def get_playlist(self, request):
+        self.user_id(request)
+        return self.playlist(request.match_info["id"], full=True)
+
+    async def get_playlist_tracks(self, request):
+        self.user_id(request)
+        limit, offset = self.paging(request, max_limit=100)
+        return self.playlist_items(request.match_info["id"], limit, offset)
+
+    async def create_playlist(self, request):
+        self.user_id(request)
+        data = codec.loads(await request.read())
+        playlist = self.playlist(_id("p", self.random.randrange(1 << 30)))
+        playlist.update(
+            name=data.get("name", playlist["name"]),
+            description=data.get("description", ""),
+            public=data.get("public", True),
+            collaborative=data.get("collaborative", False),
+        )
+        return playlist
+
+    async def add_to_playlist(self, request):
+        self.user_id(request)
+        data = codec.loads(await request.read())
+        if len(data.get("uris", [])) > 100:
+            raise self.error(400, "Too many ids requested")
+        return {"snapshot_id": str(self.random.randrange(1 << 30))}
+
+    async def get_user(self, request):
+        self.user_id(request)
+        return self.user(request.match_info["user_id"])
+
+    async def recommendations(self, request):
+        self.user_id(request)
+        limit = min(int(request.query.get("limit", 20)), 100)
+        seed = urlencode(sorted(request.query.items()))
+        indices = self.sample(seed, self.tracks, limit)
+        tracks = [self.track(_id("t", i)) for i in indices]
+        return {"seeds": [], "tracks": tracks}
+
+    async def genre_seeds(self, request):
+        self.user_id(request)
+        return {"genres": GENRES}
+
+    # Server
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        route = request.match_info.route.resource
+        name = route.canonical if route is not None else "unknown"
+        self.requests[f"{request.method} {name}"] += 1
+
+        await asyncio.sleep(max(0, self.random.gauss(self.latency, self.jitter)))
+        if self.random.random() < self.throttle_rate:
+            response = web.json_response(
+                {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        elif self.random.random() < self.error_rate:
+            response = web.json_response(
+                {"error": {"status": 503, "message": "Service unavailable"}},
+                status=503,
+            )
+        else:
+            try:
+                response = await self.respond(request, await handler(request))
+            except web.HTTPException as e:
+                response = e
+        self.statuses[response.status] += 1
+        return response
+
+    async def respond(self, request, data):
+        if data is None:
+            return web.Response(status=204)
+        body = codec.dumps(data).encode()
+        etag = '"%08x"' % zlib.crc32(body)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            body=body, content_type="application/json", headers={"ETag": etag}
+        )
+
+    async def stats(self, request):
+        return {"requests": dict(self.requests), "statuses": dict(self.statuses)}
+
+    def accounts_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/authorize", self.authorize)
+        app.router.add_post("/api/token", self.token)
+        return app
+
+    def api_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        for method, path, handler in [
+            ("GET", "/_stats", self.stats),
+            ("GET", "/v1/me", self.me),
+            ("GET", "/v1/me/top/{kind:tracks|artists}", self.get_top),
+            ("GET", "/v1/me/tracks", self.get_liked),
+            ("GET", "/v1/me/albums", self.get_saved_albums),
+            ("GET", "/v1/me/playlists", self.my_playlists),
+            ("GET", "/v1/me/player/recently-played", self.recently_played),
+            ("GET", "/v1/me/player/currently-playing", self.currently_playing),
+            ("GET", "/v1/tracks", self.get_tracks),
+            ("GET", "/v1/tracks/{id}", self.get_track),
+            ("GET", "/v1/audio-features", self.get_many_features),
+            ("GET", "/v1/audio-features/{id}", self.get_features),
+            ("GET", "/v1/albums", self.get_albums),
+            ("GET", "/v1/albums/{id}", self.get_album),
+            ("GET", "/v1/albums/{id}/tracks", self.get_album_tracks),
+            ("GET", "/v1/artists", self.get_artists),
+            ("GET", "/v1/artists/{id}", self.get_artist),
+            ("GET", "/v1/artists/{id}/top-tracks", self.get_artist_top_tracks),
+            ("GET", "/v1/artists/{id}/top_tracks", self.get_artist_top_tracks),
+            ("GET", "/v1/playlists/{id}", self.get_playlist),
+            ("GET", "/v1/playlists/{id}/tracks", self.get_playlist_tracks),
+            ("POST", "/v1/playlists/{id}/tracks", self.add_to_playlist),
+            ("GET", "/v1/users/{user_id}", self.get_user),
+            ("GET", "/v1/users/{user_id}/playlists", self.other_playlists),
+            ("POST", "/v1/users/{user_id}/playlists", self.create_playlist),
+            ("GET", "/v1/recommendations", self.recommendations),
+            ("GET", "/v1/recommendations/available-genre-seeds", self.genre_seeds),
+        ]:
+            app.router.add_route(method, path, handler)
+        return app
+
+    async def start(self, host="localhost", api_port=8001, accounts_port=8002):
+        """
+        Serves the API and accounts hosts on separate ports,
+        like Spotify, so each gets its own connection pool.
+        Returns the runners to clean up.
+        """
+        runners = []
+        for app, port in [
+            (self.api_app(), api_port),
+            (self.accounts_app(), accounts_port),
+        ]:
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            runners.append(runner)
+        return runners
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Spotify Web API stand-in")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--api-port", type=int, default=8001)
+    parser.add_argument("--accounts-port", type=int, default=8002)
+    parser.add_argument("--tracks", type=int, default=50000, help="catalog size")
+    parser.add_argument("--liked", type=int, default=500)
+    parser.add_argument("--top", type=int, default=99)
+    parser.add_argument("--playlists", type=int, default=20)
+    parser.add_argument("--playlist-tracks", type=int, default=100)
+    parser.add_argument("--saved-albums", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503s")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = vars(parser.parse_args())
+
+    address = {k: args.pop(k) for k in ("host", "api_port", "accounts_port")}
+    server = FakeSpotify(**args)
+
+    loop = asyncio.get_event_loop()
+    runners = loop.run_until_complete(server.start(**address))
+    host, api, accounts = address.values()
+    print(f"api_url = \"http://{host}:{api}/v1/\"")
+    print(f"accounts_url = \"http://{host}:{accounts}/\"")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for runner in runners:
+            loop.run_until_complete(runner.cleanup())
+
+
+if __name__ == "__main__":
+    main()
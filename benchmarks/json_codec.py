@@ -0,0 +1,109 @@
+# Compares the installed JSON backends on Spotify shaped payloads.
+# Run from the repository root: python -m benchmarks.json_codec
+
+import sys
+import timeit
+
+from utilities import codec
+
+
+def _image(size):
+    return {
+        "height": size,
+        "width": size,
+        "url": f"https://i.scdn.co/image/ab67616d0000b273{size:024x}",
+    }
+
+
+def _artist(i):
+    return {
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/{i:022d}"},
+        "href": f"https://api.spotify.com/v1/artists/{i:022d}",
+        "id": f"{i:022d}",
+        "name": f"Artist {i} – Ωmega",
+        "type": "artist",
+        "uri": f"spotify:artist:{i:022d}",
+    }
+
+
+def _track(i):
+    return {
+        "album": {
+            "album_type": "album",
+            "artists": [_artist(i)],
+            "external_urls": {"spotify": f"https://open.spotify.com/album/{i:022d}"},
+            "id": f"{i:022d}",
+            "images": [_image(640), _image(300), _image(64)],
+            "name": f"Album {i}",
+            "release_date": "2019-03-29",
+            "release_date_precision": "day",
+            "total_tracks": 12,
+            "type": "album",
+            "uri": f"spotify:album:{i:022d}",
+        },
+        "artists": [_artist(i), _artist(i + 1)],
+        "disc_number": 1,
+        "duration_ms": 215000 + i,
+        "explicit": bool(i % 2),
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{i:022d}"},
+        "id": f"{i:022d}",
+        "is_local": False,
+        "name": f"Track {i} (feat. Someone)",
+        "popularity": i % 100,
+        "preview_url": None,
+        "track_number": i % 12 + 1,
+        "type": "track",
+        "uri": f"spotify:track:{i:022d}",
+    }
+
+
+def _features(i):
+    return {
+        "acousticness": 0.0123 * (i % 80),
+        "danceability": 0.735,
+        "duration_ms": 215000 + i,
+        "energy": 0.578,
+        "id": f"{i:022d}",
+        "instrumentalness": 0.0,
+        "key": i % 12,
+        "liveness": 0.0955,
+        "loudness": -6.264,
+        "mode": 1,
+        "speechiness": 0.0461,
+        "tempo": 120.021,
+        "time_signature": 4,
+        "valence": 0.624,
+    }
+
+
+PAYLOADS = {
+    "top tracks page (50)": {
+        "items": [_track(i) for i in range(50)],
+        "limit": 50,
+        "next": None,
+        "offset": 0,
+        "total": 50,
+    },
+    "audio features (100)": {"audio_features": [_features(i) for i in range(100)]},
+    "single track": _track(7),
+}
+
+
+def _per_call(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return best / number * 1e6  # µs
+
+
+def main(number=2000):
+    print(f"default backend: {codec.BACKEND}")
+    for payload_name, payload in PAYLOADS.items():
+        encoded = codec.BACKENDS["json"][0](payload).encode()
+        print(f"\n{payload_name}, {len(encoded)} bytes")
+        for name, (dumps, loads) in codec.BACKENDS.items():
+            dump = _per_call(lambda: dumps(payload), number)
+            load = _per_call(lambda: loads(encoded), number)
+            print(f"  {name:<8} dumps {dump:>8.1f} µs   loads {load:>8.1f} µs")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,224 @@
+# Simulates logged in users browsing Sketyl against the fake Spotify server.
+# Point config.SPOTIFY.api_url and accounts_url at the fake server's ports,
+# then run from the repository root: python -m benchmarks.load_test --help
+#
+# With --launch it starts the fake server and web.py itself, otherwise both
+# must already be running (and --app-pid gives the peak RSS of the app).
+
+import argparse
+import asyncio
+import math
+import random
+import subprocess
+import sys
+import time
+
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import config
+from benchmarks.fake_spotify import FakeSpotify, _id
+from utilities import spotify
+
+# Route template -> weight, close to what people actually click on
+ROUTES = {
+    "/": 4,
+    "/spotify/top_tracks/": 3,
+    "/spotify/top_artists/": 2,
+    "/spotify/liked/": 2,
+    "/spotify/recent/": 2,
+    "/spotify/decades": 1,
+    "/spotify/playlists": 1,
+    "/spotify/playlists/<id>": 2,
+    "/spotify/albums": 1,
+    "/profile/": 1,
+}
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return float("nan")
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def peak_rss(pid):
+    """Peak resident set size in MiB, Linux only"""
+    try:
+        with open(f"/proc/{pid}/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+
+class VirtualUser:
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.id = user_id
+        self.session = aiohttp.ClientSession(
+            cookie_jar=aiohttp.CookieJar(unsafe=True)  # Cookies for localhost
+        )
+        self.playlists = [
+            _id("p", i)
+            for i in harness.fake.sample(
+                user_id + ":playlists", 1 << 30, harness.fake.playlists
+            )
+        ]
+
+    async def login(self):
+        """Goes through /spotify/connect, logging in to the fake as this user"""
+        url = self.harness.app_url + "/spotify/connect"
+        async with self.session.get(url, allow_redirects=False) as res:
+            authorize = res.headers["Location"] + "&login=" + self.id
+        async with self.session.get(authorize, allow_redirects=False) as res:
+            callback = res.headers["Location"]
+        async with self.session.get(callback, allow_redirects=False) as res:
+            if "user_id" not in res.cookies:
+                raise RuntimeError(f"Login failed for {self.id}: {res.status}")
+
+    def path(self, route):
+        if route == "/spotify/playlists/<id>":
+            return "/spotify/playlists/" + random.choice(self.playlists)
+        if route == "/profile/":
+            return "/profile/?id=" + self.id
+        return route
+
+    async def browse(self, until, think):
+        routes, weights = zip(*ROUTES.items())
+        while time.monotonic() < until:
+            route = random.choices(routes, weights)[0]
+            start = time.monotonic()
+            try:
+                async with self.session.get(
+                    self.harness.app_url + self.path(route)
+                ) as res:
+                    await res.read()
+                    ok = res.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            self.harness.record(route, time.monotonic() - start, ok)
+            if think:
+                await asyncio.sleep(random.expovariate(1 / think))
+
+    async def close(self):
+        await self.session.close()
+
+
+class Harness:
+    def __init__(self, app_url, fake, *, users=20, duration=30, think=0.0):
+        self.app_url = app_url.rstrip("/")
+        self.fake = fake
+        self.users = users
+        self.duration = duration
+        self.think = think  # Mean seconds between a user's page views
+
+        self.latencies = defaultdict(list)  # route -> seconds
+        self.errors = defaultdict(int)
+        self.outbound = 0
+        self.elapsed = 0
+
+    def record(self, route, seconds, ok):
+        self.latencies[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+    async def outbound_calls(self, session):
+        api = urlsplit(spotify.CONSTANTS.API_URL)
+        async with session.get(f"{api.scheme}://{api.netloc}/_stats") as res:
+            stats = await res.json()
+        return sum(stats["requests"].values())
+
+    async def run(self):
+        users = [VirtualUser(self, f"loaduser{i}") for i in range(self.users)]
+        async with aiohttp.ClientSession() as session:
+            try:
+                await asyncio.gather(*(user.login() for user in users))
+                before = await self.outbound_calls(session)
+
+                start = time.monotonic()
+                until = start + self.duration
+                await asyncio.gather(*(u.browse(until, self.think) for u in users))
+                self.elapsed = time.monotonic() - start
+
+                self.outbound = await self.outbound_calls(session) - before
+            finally:
+                await asyncio.gather(*(user.close() for user in users))
+
+    def report(self, rss=None):
+        views = sum(map(len, self.latencies.values()))
+        print(f"{self.users} users for {self.elapsed:.1f}s, {views} page views")
+        print(f"throughput        {views / self.elapsed:.1f} views/s")
+        print(f"outbound per view {self.outbound / max(views, 1):.2f} Spotify calls")
+        print(f"peak RSS          " + (f"{rss:.1f} MiB" if rss else "n/a"))
+        print()
+
+        width = max(map(len, ROUTES))
+        print(f"{'route':<{width}}  {'views':>6} {'errors':>6}", end="")
+        print(f"  {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for route in ROUTES:
+            ordered = sorted(self.latencies[route])
+            p50, p95, p99 = (percentile(ordered, p) * 1000 for p in (50, 95, 99))
+            errors = self.errors[route]
+            print(f"{route:<{width}}  {len(ordered):>6} {errors:>6}", end="")
+            print(f"  {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}")
+
+
+async def wait_until_up(url, timeout=30):
+    until = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < until:
+            try:
+                async with session.get(url) as res:
+                    await res.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def main(args):
+    fake = FakeSpotify(
+        latency=args.latency, throttle_rate=args.throttle_rate, seed=args.seed
+    )
+    runners = app = None
+    if args.launch:
+        api = urlsplit(spotify.CONSTANTS.API_URL)
+        accounts = urlsplit(spotify.CONSTANTS.ACCOUNTS_URL)
+        runners = await fake.start(api.hostname, api.port, accounts.port)
+        app = subprocess.Popen([sys.executable, "web.py"])
+        args.app_pid = app.pid
+
+    try:
+        await wait_until_up(args.app_url)
+        harness = Harness(
+            args.app_url,
+            fake,
+            users=args.users,
+            duration=args.duration,
+            think=args.think,
+        )
+        await harness.run()
+        harness.report(peak_rss(args.app_pid) if args.app_pid else None)
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        for runner in runners or []:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sketyl load test")
+    parser.add_argument("--app-url", default=config.BASE_WEB_URL)
+    parser.add_argument("--app-pid", type=int, help="for peak RSS")
+    parser.add_argument("--launch", action="store_true", help="start fake and app")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.05, help="--launch")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="--launch")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,53 @@
+BASE_WEB_URL = "http://localhost:3000/"
+
+
+class POSTGRES:
+    user = "postgres"
+    password = "postgres password"
+    host = "localhost"
+    port = 5432
+    name = "Sketyl"
+    uri = f"postgres://{user}:{password}@{host}:{port}/{name}"
+
+
+class SPOTIFY:
+    client_id = "go to spotify dev portal and get"
+    client_secret = "ditto"
+    redirect_uri = BASE_WEB_URL + "spotify/connect"  # Add this as redirect uri
+    # Point these at python -m benchmarks.fake_spotify to run without Spotify
+    api_url = "http://localhost:8001/v1/"
+    accounts_url = "http://localhost:8002/"
+
+
+class CACHE:
+    max_entries = 1024  # Full tracks kept by get_full_track
+    max_bytes = 128 * 1024 * 1024  # 128 MiB
+    disk_path = None  # None to keep caches in memory only
+    disk_max_bytes = 256 * 1024 * 1024
+    max_memory = 512 * 1024 * 1024  # 512 MiB across every cached function
+    refresh_rate = 2  # Background refreshes of hot keys per second
+
+
+class HTTP:
+    rate_limit = 20  # Requests per second to each Spotify host, None to disable
+    rate_burst = 40
+    max_retries = 3  # For 5xx and connection errors on idempotent requests
+    request_deadline = 10  # Seconds for all attempts of one request
+    max_connections = 100  # Per pool, 0 for no limit
+    max_connections_per_host = 50
+    auth_max_connections = 10  # Separate pool for accounts.spotify.com
+    keepalive_timeout = 30  # Seconds an idle connection is kept open
+    dns_cache_ttl = 300  # Seconds, None to cache forever
+    connect_timeout = 5
+    read_timeout = 15
+    slow_request = 1  # Seconds before a request is logged, None to disable
+    cassette = None  # Path to record Spotify responses to, or replay from
+    cassette_mode = "replay"  # Or "record"
+    cassette_latency = 0  # Seconds added to each replayed response
+    breaker_threshold = 5  # Consecutive failures before an endpoint fails fast
+    breaker_recovery = 30  # Seconds before it's tried again
+    page_budget = 8  # Seconds all Spotify calls for one page may take
+
+
+class METRICS:
+    token = "localtoken"
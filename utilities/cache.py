@@ -1,137 +1,1181 @@
 import inspect
 import asyncio
+import contextvars
+import heapq
+import itertools
 import enum
 import time
+import sys
+import pickle
+import sqlite3
+import random
 
-from functools import wraps
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 
-CACHE = {}
+from utilities import http  # Imports cache too, only used at call time
 
+_EXPIRING_CACHES = []
+_REGISTRY = []  # CacheStats of every decorated function
+_DISK = None  # DiskTier behind the in-memory caches, see enable_disk_tier
+_DEGRADED = contextvars.ContextVar("degraded", default=None)
 
-def _get_cached_value(id_or_ids):
-    if type(id_or_ids) is list:
-        return [CACHE[_id] for _id in id_or_ids]
-    return CACHE[id_or_ids]
+DEGRADED_TTL = 30  # Seconds a partial result is kept, see degrade
 
 
-def _wrap_and_store_coroutine(cache, key, coro):
-    async def func():
-        value = await coro
-        cache[key] = value
-        return value
+def degrade():
+    """
+    Marks the value being computed as partial, e.g. tracks
+    without features. It's kept for DEGRADED_TTL at most,
+    never written to disk, and so is anything cached that
+    was built from it.
+    """
+    flag = _DEGRADED.get()
+    if flag is not None:
+        flag.append(True)
+
+
+async def get_many(store, ids, fetch):
+    """
+    Looks ids up in an entity store, only passing the
+    missing ones to fetch. fetch must return values in
+    the order of the ids it was given.
+    Returns values in the original order.
+    """
+    found = {}
+    missing = []
+    for _id in dict.fromkeys(ids):  # Dedupe, keep order
+        try:
+            found[_id] = store[_id]
+        except KeyError:
+            missing.append(_id)
+
+    if missing:
+        for _id, value in zip(missing, await fetch(missing)):
+            store[_id] = found[_id] = value
+
+    return [found.get(_id) for _id in ids]
+
+
+class BatchLoader:
+    """
+    Collects the ids loaded within one event loop tick and
+    passes them to fetch max_batch at a time. fetch must
+    return values in the order of the ids it was given.
+    Batches run without any caller's deadline, each caller
+    waits for as long as its own allows.
+    """
+
+    def __init__(self, fetch, max_batch):
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.__pending = {}  # id -> future
+
+    async def load(self, _id):
+        future = self.__pending.get(_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self.__pending:
+                loop.call_soon(self.__dispatch, context=http.detached_context())
+            future = self.__pending[_id] = loop.create_future()
+
+        return await _wait(future, _id)  # Shielded, other callers may share the id
+
+    def __dispatch(self):
+        pending, self.__pending = self.__pending, {}
+        ids = list(pending)
+        for i in range(0, len(ids), self.max_batch):
+            batch = {_id: pending[_id] for _id in ids[i : i + self.max_batch]}
+            asyncio.ensure_future(self.__load_batch(batch))
+
+    async def __load_batch(self, futures):
+        try:
+            values = await self.fetch(list(futures))
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, value in zip(futures.values(), values):
+                if not future.done():
+                    future.set_result(value)
+        finally:
+            for future in futures.values():  # Cancelled, or fetch came up short
+                if not future.done():
+                    future.cancel()
+
+
+class _KwargsMark:
+    """Separates positional from keyword arguments in a key"""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<kwargs>"
+
+
+_KWARGS_MARK = _KwargsMark()
+_HASHABLE_TYPES = {str, int, float, bool, bytes, type(None)}
+
+
+def _freeze(o):
+    """Hashable stand-in for an argument"""
+    cls = o.__class__
+    if cls in _HASHABLE_TYPES:
+        return o
+    if cls is list or cls is tuple:  # Usually a list of IDs
+        frozen = tuple(o)
+        try:
+            hash(frozen)
+        except TypeError:
+            frozen = tuple(_freeze(i) for i in o)
+        return frozen
+    if cls is dict:
+        return tuple((k, _freeze(v)) for k, v in o.items())
+    if cls is set:
+        return frozenset(o)
+    if hasattr(o, "id"):  # Users and other Spotify objects
+        return (cls, o.id)
+    try:
+        hash(o)
+    except TypeError:
+        return (cls, repr(o))  # Last resort, like the old repr keys
+    return o
+
+
+def _share_coroutine(in_flight, key, coro):
+    # Run the miss as its own task so one cancelled caller
+    # can't cancel the call everyone else is waiting on,
+    # and without that caller's deadline, see _wait.
+    task = http.detached_context().run(asyncio.ensure_future, coro)
+    in_flight[key] = task
+
+    def done(task):
+        if in_flight.get(key) is task:
+            del in_flight[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved by the waiters, silence the warning
+
+    task.add_done_callback(done)
+    return task
+
+
+async def _wait(task, name):
+    """Waits on a shared task for as long as the caller's own deadline allows"""
+    remaining = http.time_left()
+    if remaining is None:
+        return await asyncio.shield(task)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), remaining)
+    except asyncio.TimeoutError:
+        if task.done():
+            raise  # The task's own timeout
+        raise http.DeadlineExceeded(name) from None
+
+
+def estimate_size(obj):
+    """Approximate deep size of an object in bytes"""
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(vars(o))
+    return size
+
+
+class RemovalHooks:
+    """Calls each of removal_hooks with every key deleted from the cache"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.removal_hooks = []
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        for hook in self.removal_hooks:
+            hook(key)
+
+
+class InternalCache(RemovalHooks, dict):
+    pass
+
+
+class TagIndex:
+    """Secondary index of cache keys by (name, value) tags"""
+
+    def __init__(self):
+        self.__keys = defaultdict(set)  # tag -> keys
+        self.__tags = {}  # key -> tags
+
+    def add(self, key, tags):
+        self.discard(key)
+        self.__tags[key] = tags
+        for tag in tags:
+            self.__keys[tag].add(key)
+
+    def discard(self, key):
+        for tag in self.__tags.pop(key, ()):
+            keys = self.__keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self.__keys[tag]
+
+    def __contains__(self, key):
+        return key in self.__tags
+
+    def __iter__(self):
+        return iter(self.__tags)
+
+    def __len__(self):
+        return len(self.__tags)
+
+    def match(self, tags):
+        """Keys carrying every one of tags"""
+        sets = sorted((self.__keys.get(tag, set()) for tag in tags), key=len)
+        if not sets:
+            return set()
+        keys = set(sets[0])
+        for other in sets[1:]:
+            keys.intersection_update(other)
+        return keys
+
+
+class CacheStats:
+    """Counters for one cached function"""
+
+    def __init__(self, name, strategy, cache, index, persist=False):
+        self.name = name
+        self.strategy = strategy
+        self.cache = cache
+        self.index = index  # Keys of this function, the raw CACHE is shared
+        self.persist = persist  # Backed by the disk tier when it's enabled
 
-    return func()
+        self.hits = 0
+        self.stale_hits = 0  # Also counted in hits
+        self.misses = 0
+        self.disk_hits = 0  # Misses answered by the disk tier
+        self.coalesced = 0  # Misses that waited on another caller's request
+        self.errors = 0
+        self.degraded = 0  # Partial results, cached briefly
+        self.removals = 0
+        self.invalidations = 0
+        self.budget_evictions = 0  # Also counted in evictions
+        self.bytes = 0  # Estimated size of this function's values
+        self.fetches = 0  # Completed calls to the function, misses or refreshes
+        self.miss_seconds = 0.0
+        self.miss_seconds_max = 0.0
 
+    def record_miss(self, seconds):
+        self.fetches += 1
+        self.miss_seconds += seconds
+        self.miss_seconds_max = max(self.miss_seconds_max, seconds)
 
-def _wrap_new_coroutine(value):
-    async def new_coroutine():
+    @property
+    def evictions(self):
+        """Entries that expired or were pushed out, rather than invalidated"""
+        return self.removals - self.invalidations
+
+    @property
+    def entries(self):
+        return len(self.index)
+
+    def as_dict(self):
+        return {
+            "strategy": self.strategy.name,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "degraded": self.degraded,
+            "evictions": self.evictions,
+            "budget_evictions": self.budget_evictions,
+            "invalidations": self.invalidations,
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "miss_seconds": self.miss_seconds,
+            "miss_seconds_avg": self.miss_seconds / max(self.fetches, 1),
+            "miss_seconds_max": self.miss_seconds_max,
+        }
+
+
+def stats():
+    """Counters of every cached function by qualified name"""
+    return {s.name: s.as_dict() for s in _REGISTRY}
+
+
+def disk_stats():
+    return _DISK.stats() if _DISK is not None else None
+
+
+def _invalidate_tagged(stats, tags):
+    keys = stats.index.match(tags)
+    for key in keys:
+        try:
+            del stats.cache[key]
+        except KeyError:
+            stats.index.discard(key)
+        else:
+            stats.invalidations += 1
+    return len(keys)
+
+
+def invalidate(**tags):
+    """
+    Drops every cached entry matching all tags, across all cached functions.
+    e.g. invalidate(user=user_id) or invalidate(user=user_id, time_range="short_term")
+    """
+    tags = set(tags.items())
+    if _DISK is not None:
+        _DISK.delete_tagged(tags)
+    return sum(_invalidate_tagged(stats, tags) for stats in _REGISTRY)
+
+
+class LRUCache(RemovalHooks, OrderedDict):
+    """Keeps the most recently used entries within an entry and byte limit"""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__sizes = {}
+        self.bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def __over_limit(self):
+        if self.max_entries is not None and len(self) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.bytes > self.max_bytes
+
+    def __shrink(self):
+        while len(self) > 1 and self.__over_limit():
+            oldest = next(iter(self))
+            self.evicted_bytes += self.__sizes[oldest]
+            self.evictions += 1
+            del self[oldest]
+
+    def resize(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__shrink()
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
         return value
 
-    return new_coroutine()
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        """Stores a value, size is estimated unless the caller already knows it"""
+        if key in self:
+            del self[key]
+        if size is None:
+            size = estimate_size(value)
+        super().__setitem__(key, value)
+        self.__sizes[key] = size
+        self.bytes += size
+        self.__shrink()
 
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.bytes -= self.__sizes.pop(key)
 
-class ExpiringCache(dict):
-    def __init__(self, seconds):
+
+CACHE = LRUCache(max_entries=1024, max_bytes=128 * 1024 * 1024)
+
+
+class MemoryBudget:
+    """
+    Process wide ceiling on the estimated size of every
+    decorated function's values. Past it, the biggest of
+    the least recently used entries are evicted first.
+    """
+
+    SAMPLE = 8  # Oldest entries weighed against each other per eviction
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.__entries = OrderedDict()  # key -> (stats, size), least recent first
+
+    def add(self, stats, key, size):
+        self.discard(key)
+        self.__entries[key] = (stats, size)
+        self.bytes += size
+        stats.bytes += size
+        self.enforce(keep=key)
+
+    def touch(self, key):
+        try:
+            self.__entries.move_to_end(key)
+        except KeyError:
+            pass
+
+    def discard(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            stats, size = entry
+            self.bytes -= size
+            stats.bytes -= size
+
+    def enforce(self, keep=None):
+        while self.max_bytes is not None and self.bytes > self.max_bytes:
+            oldest = itertools.islice(self.__entries, self.SAMPLE)
+            candidates = [key for key in oldest if key != keep]
+            if not candidates:
+                break
+            victim = max(candidates, key=lambda key: self.__entries[key][1])
+            stats, size = self.__entries[victim]
+            stats.budget_evictions += 1
+            self.evictions += 1
+            self.evicted_bytes += size
+            try:
+                del stats.cache[victim]  # Removal hook discards it from here
+            except KeyError:
+                pass
+            self.discard(victim)
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.enforce()
+
+    def stats(self):
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": self.bytes,
+            "entries": len(self.__entries),
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "footprint": {s.name: s.bytes for s in _REGISTRY},
+        }
+
+
+BUDGET = MemoryBudget()
+
+
+def memory_stats():
+    return BUDGET.stats()
+
+
+class ExpiringCache(RemovalHooks, dict):
+    def __init__(self, seconds, grace=0):
         self.__ttl = seconds
-        self.__timekeeper = {}
+        self.__grace = grace  # How long expired entries may still be served stale
+        self.__timekeeper = {}  # key -> monotonic expiry time
+        self.__expiry_heap = []  # (expires_at, sequence, key), soonest first
+        self.__sequence = itertools.count()
+        self.__janitor = None
         super().__init__()
+        _EXPIRING_CACHES.append(self)
 
-    def __verify_cache_integrity(self):
-        # Have to do this in two steps...
-        current_time = time.monotonic()
-        to_remove = [
-            k for k in self.keys() if current_time > (self.__timekeeper[k] + self.__ttl)
+    def __is_expired(self, key, current_time):
+        return current_time > self.__timekeeper[key] + self.__grace
+
+    def ttl_remaining(self, key):
+        """Seconds until an entry expires, negative when stale, None if missing"""
+        expires_at = self.__timekeeper.get(key)
+        if expires_at is None:
+            return None
+        return expires_at - time.monotonic()
+
+    def is_stale(self, key):
+        """Whether an entry outlived its ttl and is only kept for the grace window"""
+        return time.monotonic() > self.__timekeeper[key]
+
+    def __compact(self):
+        # Overwritten and deleted keys leave dead heap entries behind,
+        # rebuild once they outnumber the live ones.
+        self.__expiry_heap = [
+            (expires_at, next(self.__sequence), key)
+            for key, expires_at in self.__timekeeper.items()
         ]
-        for k in to_remove:
-            del self[k]
+        heapq.heapify(self.__expiry_heap)
+
+    def purge(self):
+        """Removes every expired entry, returns how many were removed"""
+        current_time = time.monotonic()
+        heap = self.__expiry_heap
+        removed = 0
+        while heap and current_time > heap[0][0] + self.__grace:
+            expires_at, _, key = heapq.heappop(heap)
+            if self.__timekeeper.get(key) == expires_at:
+                del self[key]
+                removed += 1
+        return removed
+
+    def start_janitor(self, interval=60, *, loop=None):
+        """Periodically purges expired entries in the background"""
+        if self.__janitor is None or self.__janitor.done():
+            loop = loop or asyncio.get_event_loop()
+            self.__janitor = loop.create_task(self.__run_janitor(interval))
+        return self.__janitor
+
+    def stop_janitor(self):
+        if self.__janitor is not None:
+            self.__janitor.cancel()
+            self.__janitor = None
+
+    async def __run_janitor(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.purge()
 
     def __contains__(self, key):
-        self.__verify_cache_integrity()
-        return super().__contains__(key)
+        if not super().__contains__(key):
+            return False
+        if self.__is_expired(key, time.monotonic()):
+            del self[key]
+            return False
+        return True
 
     def __getitem__(self, key):
-        self.__verify_cache_integrity()
-        return super().__getitem__(key)
+        value = dict.__getitem__(self, key)  # Hot path, skip super()
+        if time.monotonic() > self.__timekeeper[key] + self.__grace:
+            del self[key]
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __setitem__(self, key, value):
-        self.__timekeeper[key] = time.monotonic()
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """Stores a value, for ttl seconds instead of the cache's if given"""
+        self.purge()  # Amortized, only pops entries that already expired
+        expires_at = time.monotonic() + (self.__ttl if ttl is None else ttl)
+        self.__timekeeper[key] = expires_at
+        heapq.heappush(self.__expiry_heap, (expires_at, next(self.__sequence), key))
         super().__setitem__(key, value)
 
+        if len(self.__expiry_heap) > 2 * len(self.__timekeeper) + 64:
+            self.__compact()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self.__timekeeper[key]
+
+
+class DiskTier:
+    """
+    SQLite second level behind the in-memory caches.
+    Writes are queued and flushed in batches from a single
+    worker thread, reads only happen on in-memory misses.
+    Expiry times are wall clock so they survive restarts.
+    Past max_bytes of values the oldest writes are evicted.
+    """
+
+    def __init__(self, path, *, max_bytes=None, flush_interval=1.0, loop=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+        # One thread owns the connection, which also orders reads after writes
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix="disk-cache")
+        self.__db = None
+        self.__pending = {}  # key -> (value, expires_at, tags) or None to delete
+        self.__tag_deletes = []
+        self.__flusher = self.loop.create_task(self.__run_flusher())
+
+    def __connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+            CREATE TABLE IF NOT EXISTS tags (key TEXT NOT NULL, tag TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+            CREATE INDEX IF NOT EXISTS tags_key ON tags (key);
+            """
+        )
+        return db
+
+    @property
+    def __connection(self):
+        if self.__db is None:
+            self.__db = self.__connect()
+        return self.__db
+
+    def __read(self, key):
+        row = self.__connection.execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        blob, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return pickle.loads(blob), expires_at
+
+    def __write(self, entries, tag_deletes):
+        db = self.__connection
+        rows = []
+        tag_rows = []
+        deletes = []
+        for key, entry in entries.items():
+            deletes.append((key,))
+            if entry is None:
+                continue
+            value, expires_at, tags = entry
+            try:
+                blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:  # Not everything we cache can be pickled
+                self.errors += 1
+                continue
+            rows.append((key, blob, expires_at))
+            tag_rows.extend((key, repr(tag)) for tag in tags)
+
+        now = time.time()
+        with db:
+            for tags in tag_deletes:
+                self.__delete_tagged(db, tags)
+            db.executemany("DELETE FROM tags WHERE key = ?", deletes)
+            db.executemany("DELETE FROM cache WHERE key = ?", deletes)
+            db.executemany("INSERT INTO cache VALUES (?, ?, ?)", rows)
+            db.executemany("INSERT INTO tags VALUES (?, ?)", tag_rows)
+            db.execute(
+                "DELETE FROM tags WHERE key IN "
+                "(SELECT key FROM cache WHERE expires_at < ?)",
+                (now,),
+            )
+            db.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            if rows and self.max_bytes is not None:
+                self.__evict(db)
+        self.writes += len(rows)
+
+    def __evict(self, db):
+        # Rows are reinserted on every write, so rowid orders them by age
+        evicted = db.execute(
+            "SELECT key FROM (SELECT key, SUM(length(value)) "
+            "OVER (ORDER BY rowid DESC) AS newer FROM cache) WHERE newer > ?",
+            (self.max_bytes,),
+        ).fetchall()
+        db.executemany("DELETE FROM tags WHERE key = ?", evicted)
+        db.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def __delete_tagged(self, db, tags):
+        select = "SELECT key FROM tags WHERE tag = ?"
+        matching = " INTERSECT ".join([select] * len(tags))
+        params = [repr(tag) for tag in tags]
+        db.execute(f"DELETE FROM cache WHERE key IN ({matching})", params)
+        db.execute(f"DELETE FROM tags WHERE key IN ({matching})", params)
+
+    async def get(self, key):
+        """(value, expires_at) or None if missing or expired"""
+        key = repr(key)
+        if key in self.__pending:  # Not flushed yet
+            entry = self.__pending[key]
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                return None
+            return entry[:2]
+
+        try:
+            entry = await self.loop.run_in_executor(self.__executor, self.__read, key)
+        except Exception:
+            self.errors += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, value, expires_at, tags):
+        self.__pending[repr(key)] = (value, expires_at, tags)
+
+    def delete(self, key):
+        self.__pending[repr(key)] = None
+
+    def delete_tagged(self, tags):
+        """Queues removal of every entry carrying all of tags"""
+        tags = sorted(tags, key=repr)
+        for key, entry in list(self.__pending.items()):
+            if entry is not None and entry[2].issuperset(tags):
+                del self.__pending[key]
+        self.__tag_deletes.append(tags)
+
+    async def flush(self):
+        if not self.__pending and not self.__tag_deletes:
+            return
+        entries, self.__pending = self.__pending, {}
+        tag_deletes, self.__tag_deletes = self.__tag_deletes, []
+        try:
+            await self.loop.run_in_executor(
+                self.__executor, self.__write, entries, tag_deletes
+            )
+        except Exception:
+            self.errors += 1
+
+    async def __run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        self.__flusher.cancel()
+        await self.flush()
+        if self.__db is not None:
+            db, self.__db = self.__db, None
+            await self.loop.run_in_executor(self.__executor, db.close)
+        self.__executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "pending": len(self.__pending),
+        }
+
+
+def enable_disk_tier(path, *, max_bytes=None, flush_interval=1.0, loop=None):
+    """Puts an on-disk tier behind every persisted cache"""
+    global _DISK
+    _DISK = DiskTier(
+        path, max_bytes=max_bytes, flush_interval=flush_interval, loop=loop
+    )
+    return _DISK
+
+
+async def close_disk_tier():
+    global _DISK
+    if _DISK is not None:
+        disk, _DISK = _DISK, None
+        await disk.close()
+
+
+def start_janitors(interval=60, *, loop=None):
+    """Starts a background purge task for every timed cache"""
+    return [c.start_janitor(interval, loop=loop) for c in _EXPIRING_CACHES]
+
+
+class RefreshScheduler:
+    """
+    Refreshes frequently read keys shortly before they expire,
+    hottest first and at most rate refreshes per second so
+    background traffic can't crowd out page loads.
+    """
+
+    def __init__(self, rate=2.0, burst=10, interval=10.0, min_hits=3):
+        self.rate = rate
+        self.burst = burst
+        self.interval = interval
+        self.min_hits = min_hits  # Decayed hits a key needs to count as hot
+
+        self.tokens = burst
+        self.refreshes = 0
+        self.skipped = 0  # Due, but over the rate budget
+
+        self.__last_refill = time.monotonic()
+        self.__sources = []
+        self.__task = None
+
+    def register(self, source):
+        """source(min_hits) returns (hits, start_refresh) for keys due a refresh"""
+        self.__sources.append(source)
+
+    def __refill(self):
+        now = time.monotonic()
+        elapsed = now - self.__last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.__last_refill = now
+
+    def run_once(self):
+        self.__refill()
+        due = []
+        for source in self.__sources:
+            due.extend(source(self.min_hits))
+
+        due.sort(key=lambda entry: entry[0], reverse=True)
+        for hits, start_refresh in due:
+            if self.tokens < 1:
+                self.skipped += 1
+                continue
+            self.tokens -= 1
+            self.refreshes += 1
+            start_refresh()
+
+    def start(self, *, loop=None):
+        if self.__task is None or self.__task.done():
+            loop = loop or asyncio.get_event_loop()
+            self.__task = loop.create_task(self.__run())
+        return self.__task
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.run_once()
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": self.tokens,
+            "refreshes": self.refreshes,
+            "skipped": self.skipped,
+        }
+
+
+REFRESHER = RefreshScheduler()
+
 
 class Strategy(enum.Enum):
     timed = 1
     internal = 2
     raw = 3
+    stale = 4  # Timed, but serves expired values while refreshing in the background
+
+
+class Policy:
+    """
+    Declarative cache settings, see cache() for the fields.
+    Keeps tuning for a kind of data in one place.
+    """
+
+    def __init__(
+        self,
+        strategy=Strategy.timed,
+        ttl=3600,
+        *,
+        grace=3600,
+        persist=True,
+        refresh_ahead=None,
+        jitter=0,
+        negative_ttl=None,
+    ):
+        self.strategy = strategy
+        self.ttl = ttl
+        self.grace = grace
+        self.persist = persist
+        self.refresh_ahead = refresh_ahead
+        self.jitter = jitter
+        self.negative_ttl = negative_ttl
+
+    def __repr__(self):
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"Policy({fields})"
+
 
+def _is_empty(value):
+    """None (204 No Content) or an empty collection"""
+    if value is None:
+        return True
+    return isinstance(value, (list, tuple, dict, str)) and not value
+
+
+def cache(
+    strategy=Strategy.timed,
+    ttl=3600,
+    grace=3600,
+    persist=True,
+    refresh_ahead=None,
+    jitter=0,
+    negative_ttl=None,
+    *,
+    policy=None,
+):
+    """
+    ttl: seconds a value stays fresh, grace: extra seconds Strategy.stale serves it
+    jitter: fraction ttl is randomly spread by so entries don't expire together
+    negative_ttl: ttl for None or empty results, which are usually worth less
+    refresh_ahead: re-fetch hot keys this many seconds before they expire
+    persist: back the cache with the disk tier when it's enabled
+    policy: a Policy to take all of the above from
+    """
+    if policy is not None:
+        return cache(**vars(policy))
+
+    if refresh_ahead is not None and strategy not in (Strategy.timed, Strategy.stale):
+        raise ValueError("refresh_ahead needs a timed or stale strategy")
 
-def cache(strategy=Strategy.timed, ttl=3600):
     def decorator(func):
         if strategy is Strategy.timed:
             _internal_cache = ExpiringCache(ttl)
+        elif strategy is Strategy.stale:
+            _internal_cache = ExpiringCache(ttl, grace)
         elif strategy is Strategy.internal:
-            _internal_cache = {}
+            _internal_cache = InternalCache()
         elif strategy is Strategy.raw:
             _internal_cache = CACHE
 
+        _name = f"{func.__module__}.{func.__qualname__}"
+
         def _make_key(args, kwargs):
-            def _true_repr(o):
-                if o.__class__.__repr__ is object.__repr__:
-                    return f"<{o.id}.{o.__class__.__module__}.{o.__class__.__name__}>"
-                return repr(o)
+            key = [_name]
+            for o in args:
+                key.append(o if o.__class__ in _HASHABLE_TYPES else _freeze(o))
+            if kwargs:
+                key.append(_KWARGS_MARK)
+                for k, v in kwargs.items():
+                    key.append(k)
+                    key.append(v if v.__class__ in _HASHABLE_TYPES else _freeze(v))
+            return tuple(key)
 
-            key = [f"{func.__module__}.{func.__name__}"]
-            key.extend(_true_repr(o) for o in args)
+        # Only async results can wait on the disk tier,
+        # and internal caches hold process specific state.
+        _persist = (
+            persist
+            and strategy is not Strategy.internal
+            and asyncio.iscoroutinefunction(func)
+        )
+        _ttl = None if strategy is Strategy.raw else ttl
 
-            for k, v in kwargs.items():
+        def _entry_ttl(value):
+            if _ttl is None:
+                return None
+            if negative_ttl is not None and _is_empty(value):
+                return negative_ttl
+            if jitter:
+                return _ttl * random.uniform(1 - jitter, 1 + jitter)
+            return _ttl
 
-                key.append(_true_repr(k))
-                key.append(_true_repr(v))
+        _index = TagIndex()
+        _stats = CacheStats(_name, strategy, _internal_cache, _index, _persist)
+        _REGISTRY.append(_stats)
 
-            return ":".join(key)
+        _degraded = set()  # Keys holding a partial value, see degrade
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
+        def _on_remove(key):
+            _degraded.discard(key)
+            if key in _index:
+                _stats.removals += 1
+                _index.discard(key)
+                BUDGET.discard(key)
 
-            key = _make_key(args, kwargs)
+        _internal_cache.removal_hooks.append(_on_remove)
 
-            try:
-                value = _internal_cache[key]
-            except KeyError:
-                value = func(*args, **kwargs)
+        _signature = inspect.signature(func)
+        _function_tag = ("function", _name)
 
-                if inspect.isawaitable(value):
-                    return _wrap_and_store_coroutine(_internal_cache, key, value)
+        def _make_tags(args, kwargs):
+            bound = _signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            tags = {_function_tag}
+            for name, value in bound.arguments.items():
+                if value is None or isinstance(value, (str, int, float)):
+                    tags.add((name, value))
+                elif hasattr(value, "id"):  # User -> ("user", user.id)
+                    tags.add((type(value).__name__.lower(), value.id))
+            return tags
 
+        def _store(key, args, kwargs, value, ttl=None):
+            size = estimate_size(value)
+            if isinstance(_internal_cache, LRUCache):
+                _internal_cache.set(key, value, size)
+            elif ttl is not None and isinstance(_internal_cache, ExpiringCache):
+                _internal_cache.set(key, value, ttl)
+            else:
                 _internal_cache[key] = value
+            tags = _make_tags(args, kwargs)
+            _index.add(key, tags)
+            if key in _internal_cache:  # Entries from disk may have just expired
+                BUDGET.add(_stats, key, size)
+            return tags
+
+        async def _miss(key, args, kwargs, refresh):
+            if _persist and _DISK is not None and not refresh:
+                entry = await _DISK.get(key)
+                if entry is not None:
+                    value, expires_at = entry
+                    _stats.disk_hits += 1
+                    ttl = None if expires_at is None else expires_at - time.time()
+                    _store(key, args, kwargs, value, ttl)
+                    return value
+
+            parent = _DEGRADED.get()  # A cached caller's, this runs in its own task
+            degraded = []
+            _DEGRADED.set(degraded)
+            start = time.perf_counter()
+            try:
+                value = await func(*args, **kwargs)
+            except Exception:
+                _stats.errors += 1
+                raise
+            _stats.record_miss(time.perf_counter() - start)
+
+            if degraded:
+                _stats.degraded += 1
+                if parent is not None:
+                    parent.append(True)
+                if isinstance(_internal_cache, ExpiringCache):  # Others never expire
+                    _store(key, args, kwargs, value, min(DEGRADED_TTL, _ttl))
+                    _degraded.add(key)
                 return value
+
+            ttl = _entry_ttl(value)
+            tags = _store(key, args, kwargs, value, ttl)
+            _degraded.discard(key)
+            if _persist and _DISK is not None:
+                expires_at = None if ttl is None else time.time() + ttl
+                _DISK.put(key, value, expires_at, tags)
+            return value
+
+        _in_flight = {}  # key -> task of a miss that is still running
+
+        def _fetch(key, args, kwargs, refresh=False):
+            task = _in_flight.get(key)
+            if task is None:  # Nobody is fetching this yet
+                coro = _miss(key, args, kwargs, refresh)
+                task = _share_coroutine(_in_flight, key, coro)
+            elif not refresh:
+                _stats.coalesced += 1
+            return task
+
+        _hot = {}  # key -> [decayed hits, args, kwargs], with refresh_ahead only
+
+        def _record_hit(key, args, kwargs):
+            entry = _hot.get(key)
+            if entry is None:
+                _hot[key] = [1, args, kwargs]
             else:
-                if asyncio.iscoroutinefunction(func):
-                    return _wrap_new_coroutine(value)
+                entry[0] += 1
+
+        def _due_for_refresh(min_hits):
+            due = []
+            for key, entry in list(_hot.items()):
+                hits, args, kwargs = entry
+                remaining = _internal_cache.ttl_remaining(key)
+                if remaining is None:  # Expired or evicted, it's a miss now
+                    del _hot[key]
+                    continue
+                if hits >= min_hits and remaining <= refresh_ahead:
+                    due.append((hits, partial(_fetch, key, args, kwargs, True)))
+
+                entry[0] = hits / 2  # Decay, so only keys still being read stay hot
+                if entry[0] < 1:
+                    del _hot[key]
+            return due
+
+        if refresh_ahead is not None and asyncio.iscoroutinefunction(func):
+            REFRESHER.register(_due_for_refresh)
+
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                try:
+                    value = _internal_cache[key]
+                except KeyError:
+                    _stats.misses += 1
+                    value = await _wait(_fetch(key, args, kwargs), _name)
+                    if key in _degraded:  # Also for callers that joined the miss
+                        degrade()
+                    return value
+
+                _stats.hits += 1
+                if key in _degraded:  # Still partial, so is whatever uses it
+                    degrade()
+                BUDGET.touch(key)
+                if refresh_ahead is not None:
+                    _record_hit(key, args, kwargs)
+                if strategy is Strategy.stale and _internal_cache.is_stale(key):
+                    _stats.stale_hits += 1
+                    _fetch(key, args, kwargs, True)  # Serve stale, refresh once
+                return value
+
+        else:
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                try:
+                    value = _internal_cache[key]
+                    if strategy is Strategy.stale and _internal_cache.is_stale(key):
+                        raise KeyError(key)  # No background refresh for sync calls
+                except KeyError:
+                    _stats.misses += 1
+                    start = time.perf_counter()
+                    value = func(*args, **kwargs)
+                    _stats.record_miss(time.perf_counter() - start)
+                    _store(key, args, kwargs, value, _entry_ttl(value))
+                else:
+                    _stats.hits += 1
+                    BUDGET.touch(key)
                 return value
 
         def _invalidate(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            if _persist and _DISK is not None:
+                _DISK.delete(key)
             try:
-                del _internal_cache[_make_key(args, kwargs)]
+                del _internal_cache[key]
             except KeyError:
                 return False
             else:
+                _stats.invalidations += 1
                 return True
 
-        def _invalidate_containing(key):
-            to_remove = []
-            for k in _internal_cache.keys():
-                if key in k:
-                    to_remove.append(k)
-            for k in to_remove:
-                try:
-                    del _internal_cache[k]
-                except KeyError:
-                    continue
+        def _invalidate_tags(**tags):
+            tags = set(tags.items())
+            if _persist and _DISK is not None:
+                _DISK.delete_tagged(tags | {_function_tag})
+            return _invalidate_tagged(_stats, tags)
 
         wrapper.cache = _internal_cache
         wrapper.get_key = lambda *args, **kwargs: _make_key(args, kwargs)
         wrapper.invalidate = _invalidate
-        wrapper.invalidate_containing = _invalidate_containing
+        wrapper.invalidate_tags = _invalidate_tags
+        wrapper.stats = _stats
         return wrapper
 
     return decorator
@@ -0,0 +1,44 @@
+# JSON encoding for the hot paths, using the fastest backend installed.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj)
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+BACKENDS = {"json": (_stdlib_dumps, _stdlib_loads)}
+
+if msgspec is not None:
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def _msgspec_dumps(obj):
+        return _encoder.encode(obj).decode()
+
+    BACKENDS["msgspec"] = (_msgspec_dumps, _decoder.decode)
+
+if orjson is not None:
+
+    def _orjson_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    BACKENDS["orjson"] = (_orjson_dumps, orjson.loads)
+
+
+BACKEND = next(name for name in ("orjson", "msgspec", "json") if name in BACKENDS)
+dumps, loads = BACKENDS[BACKEND]  # dumps returns str, loads takes str or bytes
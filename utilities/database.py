@@ -5,6 +5,8 @@ import config
 import asyncio
 import asyncpg
 
+from utilities import codec
+
 
 class DB:
     """
@@ -53,7 +55,7 @@ class DB:
                     DO UPDATE SET token_info = $2
                     WHERE spotify_auth.user_id = $1;
                     """
-            await self.cxn.execute(query, user_id, json.dumps(token_info))
+            await self.cxn.execute(query, user_id, codec.dumps(token_info))
 
     async def delete_user(self, user_id):
         if self.json:
@@ -82,6 +84,6 @@ class DB:
                     """
             token_info = await self.cxn.fetchval(query, user_id)
             if token_info:
-                token_info = json.loads(token_info)
+                token_info = codec.loads(token_info)
 
         return token_info
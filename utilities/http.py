@@ -1,21 +1,784 @@
+import re
+import gzip
+import aiohttp
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import logging
+import random
+import time
+
+from collections import Counter
+from urllib.parse import urlsplit
+
+from utilities import cache, codec
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUSES = {500, 502, 503, 504}
+RETRY_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+# Path segments that are followed by an ID
+ID_COLLECTIONS = {
+    "albums",
+    "artists",
+    "audio-analysis",
+    "audio-features",
+    "categories",
+    "episodes",
+    "playlists",
+    "shows",
+    "tracks",
+    "users",
+}
+API_VERSION = re.compile(r"^v\d+$")
+
+SECRET_FIELDS = {"access_token", "refresh_token"}  # Redacted from cassettes
+CASSETTE_HEADERS = ("Content-Type", "ETag", "Retry-After")
+
+log = logging.getLogger("sketyl.http")
+
+_DEADLINE = contextvars.ContextVar("deadline", default=None)  # time.monotonic()
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of the request being handled ran out"""
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Outbound calls made within, including from tasks started
+    within, share a budget of seconds. A nested budget can
+    only shorten it, None lifts it for background work.
+    """
+    current = _DEADLINE.get()
+    if seconds is None:
+        at = None
+    else:
+        at = time.monotonic() + seconds
+        at = at if current is None else min(at, current)
+    token = _DEADLINE.set(at)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def time_left():
+    """Seconds left of the current budget, None without one"""
+    at = _DEADLINE.get()
+    return None if at is None else max(0, at - time.monotonic())
+
+
+def detached_context():
+    """
+    Copy of the current context without a deadline, for
+    shared work that outlives the caller who started it.
+    """
+    context = contextvars.copy_context()
+    context.run(_DEADLINE.set, None)
+    return context
+
+
+class RateLimited(Exception):
+    """Raised when Spotify keeps answering 429 after max_throttled_retries"""
+
+    def __init__(self, url, retry_after):
+        super().__init__(f"{url} is rate limited, retry after {retry_after:g}s")
+        self.url = url
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request to one host.
+    Callers queue in arrival order, and a 429's
+    Retry-After pauses all of them, not just the one
+    that got throttled.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate  # Requests per second, None for no limit
+        self.burst = burst
+        self.tokens = burst
+
+        self.throttled = 0  # 429s received
+        self.waiting = 0
+
+        self.__updated = time.monotonic()
+        self.__resume_at = 0
+        self.__lock = asyncio.Lock()
+
+    @property
+    def paused_for(self):
+        return max(0, self.__resume_at - time.monotonic())
+
+    def pause(self, seconds):
+        self.throttled += 1
+        self.__resume_at = max(self.__resume_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            async with self.__lock:  # FIFO, so nobody gets starved
+                while True:
+                    now = time.monotonic()
+                    if now < self.__resume_at:
+                        await asyncio.sleep(self.__resume_at - now)
+                        continue
+                    if self.rate is None:
+                        return
+
+                    elapsed = now - self.__updated
+                    self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                    self.__updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "tokens": self.tokens,
+            "waiting": self.waiting,
+            "throttled": self.throttled,
+            "paused_for": self.paused_for,
+        }
+
+
+class RetryBudget:
+    """
+    Retries allowed process wide. Every request earns a
+    fraction of a retry on top of a small steady trickle,
+    so during an outage retries can't multiply the load.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+        self.retries = 0
+        self.exhausted = 0  # Retries refused for lack of budget
+
+        self.__updated = time.monotonic()
+
+    def __refill(self, extra=0):
+        now = time.monotonic()
+        elapsed = now - self.__updated
+        self.tokens = min(
+            self.max_tokens, self.tokens + extra + elapsed * self.min_per_second
+        )
+        self.__updated = now
+
+    def deposit(self):
+        """Once per request, retries don't earn retries"""
+        self.__refill(self.ratio)
+
+    def withdraw(self):
+        self.__refill()
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        self.retries += 1
+        return True
+
+    def stats(self):
+        return {
+            "tokens": self.tokens,
+            "retries": self.retries,
+            "exhausted": self.exhausted,
+        }
+
+
+class UpstreamError(Exception):
+    """Raised when Spotify still answers 5xx once retries run out"""
+
+    def __init__(self, url, status):
+        super().__init__(f"{url} failed with {status}")
+        self.url = url
+        self.status = status
+
+
+def endpoint_template(url):
+    """Spotify URL to a template like playlists/{id}/tracks"""
+    segments = [s for s in urlsplit(url).path.split("/") if s]
+    if segments and API_VERSION.match(segments[0]):
+        segments = segments[1:]
+    template = []
+    for i, segment in enumerate(segments):
+        if i and segments[i - 1] in ID_COLLECTIONS:
+            segment = "{id}"
+        template.append(segment)
+    return "/".join(template)
+
+
+def endpoint_family(endpoint):
+    """Endpoints that fail together, me/top/{id} and me/top/tracks are me/top"""
+    parts = endpoint.split("/")
+    return "/".join(parts[:2]) if parts[0] == "me" else parts[0]
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint family that keeps failing"""
+
+    def __init__(self, family, retry_in):
+        super().__init__(f"{family} is failing, retrying in {retry_in:.0f}s")
+        self.family = family
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint family after consecutive
+    failures. Once recovery seconds pass a probe is let
+    through, success closes the circuit and failure opens
+    it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, family, threshold=5, recovery=30.0, probes=1):
+        self.family = family
+        self.threshold = threshold  # Consecutive failures before opening
+        self.recovery = recovery  # Seconds before probing again
+        self.probes = probes  # Requests let through while half open
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0  # Times the circuit opened
+        self.rejected = 0
+
+        self.__opened_at = 0
+        self.__probing = 0
+
+    @property
+    def retry_in(self):
+        return max(0, self.__opened_at + self.recovery - time.monotonic())
+
+    def __open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self.__opened_at = time.monotonic()
+
+    def acquire(self):
+        """Returns whether the request is a probe, raises if the circuit is open"""
+        if self.state == self.OPEN and not self.retry_in:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.HALF_OPEN and self.__probing < self.probes:
+            self.__probing += 1
+            return True
+        self.rejected += 1
+        raise CircuitOpenError(self.family, self.retry_in)
+
+    def release(self, probe, ok):
+        """ok is None when the caller gave up, which says nothing either way"""
+        if probe:
+            self.__probing -= 1
+        if ok is None:
+            return
+        if ok:
+            self.failures = 0
+            if probe:
+                self.state = self.CLOSED
+            return
+        self.failures += 1
+        if probe or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.__open()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_in": self.retry_in,
+        }
+
+
+# Spotify couldn't answer in time or at all, for callers that can do without
+UNAVAILABLE = (
+    CircuitOpenError,
+    UpstreamError,
+    RateLimited,
+    DeadlineExceeded,
+) + RETRY_ERRORS
+
+
+class EndpointStats:
+    """Counters for one method and endpoint template"""
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = Counter()
+        self.buckets = [0] * len(LATENCY_BUCKETS)  # Not cumulative
+        self.seconds = 0.0
+        self.seconds_max = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "statuses": {str(k): v for k, v in self.statuses.items()},
+            "buckets": {str(k): v for k, v in zip(LATENCY_BUCKETS, self.buckets)},
+            "seconds": self.seconds,
+            "seconds_max": self.seconds_max,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "throttled": self.throttled,
+        }
+
+
+class RequestStats:
+    """Outbound requests by method and endpoint, slow ones are logged"""
+
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self.endpoints = {}  # (method, endpoint) -> EndpointStats
+
+    def record(self, method, endpoint, status, seconds, received, retries, throttled):
+        stats = self.endpoints.get((method, endpoint))
+        if stats is None:
+            stats = self.endpoints[(method, endpoint)] = EndpointStats()
+        stats.count += 1
+        stats.statuses[status] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stats.buckets[i] += 1
+                break
+        stats.seconds += seconds
+        stats.seconds_max = max(stats.seconds_max, seconds)
+        stats.bytes += received
+        stats.retries += retries
+        stats.throttled += throttled
+
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            log.warning(
+                f"Slow request {method} {endpoint}: {seconds:.2f}s, status {status}, "
+                f"{received} bytes, {retries} retries, {throttled} throttled"
+            )
+
+    def stats(self):
+        return {f"{m} {e}": s.as_dict() for (m, e), s in self.endpoints.items()}
+
+
+def _retry_after(res, default=1.0):
+    try:
+        return float(res.headers.get("Retry-After", default))
+    except ValueError:  # HTTP-date, Spotify sends seconds
+        return default
+
+
+def _redact(data):
+    if isinstance(data, dict):
+        return {
+            k: "redacted" if k in SECRET_FIELDS else _redact(v) for k, v in data.items()
+        }
+    if isinstance(data, list):
+        return [_redact(v) for v in data]
+    return data
+
+
+class RecordedResponse:
+    """Just enough of aiohttp's ClientResponse for Utils.query"""
+
+    def __init__(self, entry):
+        self.status = entry["status"]
+        self.headers = entry["headers"]
+        self.__body = entry["body"].encode()
+        self.content_length = len(self.__body)
+
+    async def read(self):
+        return self.__body
+
+    async def text(self):
+        return self.__body.decode()
+
+    async def json(self):
+        return codec.loads(self.__body)
+
+
+class _Recording:
+    def __init__(self, cassette, method, url, request):
+        self.cassette = cassette
+        self.method = method
+        self.url = url
+        self.request = request
+
+    async def __aenter__(self):
+        res = await self.request.__aenter__()
+        if res.status < 500 and res.status not in (304, 429):  # Not transient
+            self.cassette.record(self.method, self.url, res, await res.read())
+        return res
+
+    async def __aexit__(self, *exc_info):
+        return await self.request.__aexit__(*exc_info)
+
+
+class _Replay:
+    def __init__(self, cassette, method, url):
+        self.cassette = cassette
+        self.method = method
+        self.url = url
+
+    async def __aenter__(self):
+        if self.cassette.latency:
+            await asyncio.sleep(self.cassette.latency)
+        return RecordedResponse(self.cassette.replay(self.method, self.url))
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class CassetteSession:
+    """Session for Utils that records through to, or replays instead of, a session"""
+
+    def __init__(self, cassette, session):
+        self.cassette = cassette
+        self.session = session
+
+    def __getattr__(self, method):
+        def request(url, *args, **kwargs):
+            if self.cassette.mode == "replay":
+                return _Replay(self.cassette, method.upper(), url)
+            request = getattr(self.session, method)(url, *args, **kwargs)
+            return _Recording(self.cassette, method.upper(), url, request)
+
+        return request
+
+
+class Cassette:
+    """
+    Spotify responses in a gzipped JSON lines file, so
+    benchmarks and tests can run offline. Tokens and
+    request headers are never written. A URL recorded
+    more than once replays its responses in turn.
+    """
+
+    def __init__(self, path, mode="replay", *, latency=0.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency  # Seconds added to every replayed response
+
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        self.__file = None
+        self.__entries = {}  # (method, url) -> cycle of entries
+        if mode == "replay":
+            self.load()
+
+    def load(self):
+        entries = {}
+        with gzip.open(self.path, "rb") as fp:
+            for line in fp:
+                entry = codec.loads(line)
+                entries.setdefault((entry["method"], entry["url"]), []).append(entry)
+        self.__entries = {k: itertools.cycle(v) for k, v in entries.items()}
+
+    def wrap(self, session):
+        return CassetteSession(self, session)
+
+    def record(self, method, url, res, raw):
+        body = raw.decode("utf-8", "replace")
+        if any(field.encode() in raw for field in SECRET_FIELDS):
+            body = codec.dumps(_redact(codec.loads(raw)))
+        headers = {h: res.headers[h] for h in CASSETTE_HEADERS if h in res.headers}
+        entry = {
+            "method": method,
+            "url": url,
+            "status": res.status,
+            "headers": headers,
+            "body": body,
+        }
+        if self.__file is None:
+            self.__file = gzip.open(self.path, "ab")
+        self.__file.write(codec.dumps(entry).encode() + b"\n")
+        self.recorded += 1
+
+    def replay(self, method, url):
+        entries = self.__entries.get((method, url))
+        if entries is None:
+            self.missing += 1
+            log.warning(f"Not in cassette: {method} {url}")
+            return {
+                "status": 404,
+                "headers": {"Content-Type": "application/json"},
+                "body": '{"error": {"status": 404, "message": "Not recorded"}}',
+            }
+        self.replayed += 1
+        return next(entries)
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "missing": self.missing,
+        }
+
+
 class Utils:
     ##############################
     ## Aiohttp Helper Functions ##
     ##############################
 
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        *,
+        rate=None,
+        burst=1,
+        max_throttled_retries=5,
+        max_retries=3,
+        retry_base_delay=0.2,
+        retry_max_delay=2.0,
+        request_deadline=None,
+        retry_budget=None,
+        sessions=None,
+        timeout=None,
+        etag_entries=10000,
+        etag_bytes=64 * 1024 * 1024,
+        slow_seconds=None,
+        cassette=None,
+        breaker_threshold=5,
+        breaker_recovery=30.0,
+    ):
+        self.cassette = cassette  # Records or replays every session's traffic
+        if cassette is not None:
+            session = cassette.wrap(session)
+            sessions = {h: cassette.wrap(s) for h, s in (sessions or {}).items()}
         self.session = session
+        self.sessions = sessions or {}  # host -> session with its own pool
+        self.timeout = timeout  # Connect and read timeouts kept under a deadline
+        self.rate = rate
+        self.burst = burst
+        self.max_throttled_retries = max_throttled_retries  # 429s before giving up
+        self.limiters = {}  # host -> RateLimiter
+
+        # Transient 5xx and connection errors, idempotent methods only
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.request_deadline = request_deadline  # Seconds for every attempt
+        self.retry_budget = retry_budget or RetryBudget()
+
+        # (scope, url) -> (etag, parsed body), revalidated with If-None-Match
+        self.etags = cache.LRUCache(max_entries=etag_entries, max_bytes=etag_bytes)
+        self.not_modified = 0
+
+        self.requests = RequestStats(slow_seconds)  # Logged when slower than this
+
+        self.breaker_threshold = breaker_threshold
+        self.breaker_recovery = breaker_recovery
+        self.breakers = {}  # Endpoint family -> CircuitBreaker
+
+    def session_for(self, url):
+        return self.sessions.get(urlsplit(url).netloc, self.session)
+
+    def breaker_for(self, endpoint):
+        family = endpoint_family(endpoint)
+        breaker = self.breakers.get(family)
+        if breaker is None:
+            breaker = self.breakers[family] = CircuitBreaker(
+                family, self.breaker_threshold, self.breaker_recovery
+            )
+        return breaker
+
+    def forget(self, scope):
+        """Drops every stored response of an etag_scope, e.g. a user who left"""
+        for key in [key for key in self.etags if key[0] == scope]:
+            del self.etags[key]
+
+    def limiter_for(self, url):
+        host = urlsplit(url).netloc
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = RateLimiter(self.rate, self.burst)
+        return limiter
+
+    def __backoff(self, attempt, deadline):
+        # Exponential with full jitter, never sleeping past the deadline
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+        delay = random.uniform(0, delay)
+        if deadline is not None:
+            delay = min(delay, max(0, deadline - time.monotonic()))
+        return delay
+
+    def __can_retry(self, method, attempt, deadline):
+        if method.upper() not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        return self.retry_budget.withdraw()
+
+    def __time_left(self, url, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:  # ClientTimeout(total=0) would mean no timeout at all
+            raise asyncio.TimeoutError(f"No time left for {url}")
+        return remaining
+
+    def __timeout(self, total):
+        if self.timeout is None:
+            return aiohttp.ClientTimeout(total=total)
+        return aiohttp.ClientTimeout(
+            total=total, connect=self.timeout.connect, sock_read=self.timeout.sock_read
+        )
+
+    async def __read(self, res, res_method):
+        if res.status == 204:
+            return None, 0  # No content
+        # Read errors, timeouts and cancellation propagate as they are
+        raw = await res.read()  # Kept on res, so res.text() won't read again
+        try:
+            if res_method == "json":  # Parsed by the fastest installed codec
+                return (codec.loads(raw) if raw.strip() else None), len(raw)
+            return await getattr(res, res_method)(), len(raw)
+        except Exception:
+            raise Exception(raw.decode(errors="replace"))
+
+    async def query(self, url, *args, **kwargs):
+        """
+        etag_scope: who the response belongs to, a user id for
+        personal data. When given, GETs are revalidated against
+        the last body Spotify sent instead of downloaded again.
+        That body is returned to every caller, so treat
+        responses as read-only and copy before changing them.
+        Raises CircuitOpenError while the endpoint keeps failing,
+        UpstreamError when a 5xx outlasts the retries,
+        RateLimited when throttling doesn't let up, and
+        DeadlineExceeded once the request's budget is spent.
+        """
+        at = _DEADLINE.get()
+        if at is None:
+            return await self.__query(url, *args, **kwargs)
+
+        remaining = at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(url)
+        try:
+            return await asyncio.wait_for(self.__query(url, *args, **kwargs), remaining)
+        except asyncio.TimeoutError:
+            if time.monotonic() < at:
+                raise  # Its own request_deadline, not the budget
+            raise DeadlineExceeded(url) from None
+
+    async def __query(
+        self, url, method="get", res_method="text", *args, etag_scope=None, **kwargs
+    ):
+        start = time.monotonic()
+        endpoint = endpoint_template(url)
+        breaker = self.breaker_for(endpoint)
+        probe = breaker.acquire()
+        limiter = self.limiter_for(url)
+        session = self.session_for(url)
+        etag_key = stored = None
+        if etag_scope is not None and method.upper() == "GET":
+            etag_key = (etag_scope, url, res_method)
+            stored = self.etags.get(etag_key)
+            if stored is not None:
+                kwargs["headers"] = {**(kwargs.get("headers") or {})}
+                kwargs["headers"]["If-None-Match"] = stored[0]
+        deadline = _DEADLINE.get()  # No retries or backoff past the budget either
+        if self.request_deadline is not None:
+            own = start + self.request_deadline
+            deadline = own if deadline is None else min(deadline, own)
+        self.retry_budget.deposit()
+
+        status = None  # Until a response or a transport error
+        received = 0
+        throttled = 0
+        attempt = 0
+        try:
+            while True:
+                if deadline is None:
+                    await limiter.acquire()
+                else:  # Queueing and 429 pauses count against the deadline too
+                    remaining = self.__time_left(url, deadline)
+                    await asyncio.wait_for(limiter.acquire(), remaining)
+                    kwargs["timeout"] = self.__timeout(self.__time_left(url, deadline))
+                try:
+                    async with getattr(session, method.lower())(
+                        url, *args, **kwargs
+                    ) as res:
+                        status = res.status
+                        if status == 429:
+                            retry_after = _retry_after(res)
+                            if throttled >= self.max_throttled_retries or (
+                                deadline is not None
+                                and time.monotonic() + retry_after >= deadline
+                            ):
+                                raise RateLimited(url, retry_after)
+                            limiter.pause(retry_after)  # Queue behind the pause
+                            throttled += 1
+                            continue
+                        if status == 304 and stored is not None:
+                            self.not_modified += 1
+                            return stored[1]
+                        if status not in RETRY_STATUSES:
+                            body, received = await self.__read(res, res_method)
+                            etag = res.headers.get("ETag")
+                            if etag_key is not None and etag and status == 200:
+                                self.etags[etag_key] = (etag, body)
+                            return body
+                        if not self.__can_retry(method, attempt, deadline):
+                            raise UpstreamError(url, status)
+                except RETRY_ERRORS:
+                    status = "error"
+                    if not self.__can_retry(method, attempt, deadline):
+                        raise
+
+                await asyncio.sleep(self.__backoff(attempt, deadline))
+                attempt += 1
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            if status is None or status == "cancelled":
+                breaker.release(probe, None)  # Spotify never got a say
+            else:
+                failed = status == "error" or status in RETRY_STATUSES
+                breaker.release(probe, not failed)
+            self.requests.record(
+                method.upper(),
+                endpoint,
+                "error" if status is None else status,
+                time.monotonic() - start,
+                received,
+                attempt,
+                throttled,
+            )
 
-    async def query(self, url, method="get", res_method="text", *args, **kwargs):
-        async with getattr(self.session, method.lower())(url, *args, **kwargs) as res:
-            if res.status == 204:
-                return None  # No content
-            try:
-                return await getattr(res, res_method)()
-            except:
-                print(res)
-                res = await getattr(res, "text")()
-                raise Exception(res)
+    def stats(self):
+        return {
+            "limiters": {host: l.stats() for host, l in self.limiters.items()},
+            "retry_budget": self.retry_budget.stats(),
+            "etags": dict(self.etags.stats(), not_modified=self.not_modified),
+            "requests": self.requests.stats(),
+            "cassette": self.cassette.stats() if self.cassette else None,
+            "breakers": {f: b.stats() for f, b in self.breakers.items()},
+        }
 
     async def get(self, url, *args, **kwargs):
         return await self.query(url, "get", *args, **kwargs)
@@ -0,0 +1,99 @@
+# Renders internal counters in the Prometheus text exposition format.
+
+import itertools
+
+from utilities import cache, http
+
+CACHE_COUNTERS = {
+    "hits": "Cache hits, including stale hits",
+    "stale_hits": "Expired values served while refreshing",
+    "misses": "Cache misses",
+    "disk_hits": "Misses answered by the disk tier",
+    "coalesced": "Misses that waited on an in-flight call",
+    "errors": "Misses whose call raised",
+    "degraded": "Partial results, cached briefly",
+    "evictions": "Entries that expired or were evicted",
+    "budget_evictions": "Entries evicted to stay within the memory budget",
+    "invalidations": "Entries dropped by invalidation",
+    "miss_seconds": "Time spent computing missed values",
+}
+CACHE_GAUGES = {
+    "entries": "Entries currently cached",
+    "bytes": "Approximate size of cached values",
+    "miss_seconds_max": "Slowest miss",
+}
+HTTP_COUNTERS = {
+    "bytes": ("received_bytes", "Response bytes received"),
+    "retries": ("retries", "Retries after 5xx or connection errors"),
+    "throttled": ("throttled", "Retries after a 429"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render(families):
+    """
+    families: iterable of (name, type, help, samples)
+    where samples is a list of (labels dict, value) or
+    (labels dict, value, suffix) for histogram series.
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value, *suffix in samples:
+            lines.append(f"{name}{''.join(suffix)}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def cache_families(stats=None):
+    stats = stats or cache.stats()
+    for field, help_text in CACHE_COUNTERS.items():
+        samples = [({"function": name}, s[field]) for name, s in stats.items()]
+        yield f"sketyl_cache_{field}_total", "counter", help_text, samples
+    for field, help_text in CACHE_GAUGES.items():
+        samples = [({"function": name}, s[field]) for name, s in stats.items()]
+        yield f"sketyl_cache_{field}", "gauge", help_text, samples
+
+
+def http_families(requests):
+    endpoints = [
+        ({"method": method, "endpoint": endpoint}, s)
+        for (method, endpoint), s in requests.endpoints.items()
+    ]
+    samples = [
+        (dict(labels, status=status), count)
+        for labels, s in endpoints
+        for status, count in s.statuses.items()
+    ]
+    yield "sketyl_http_requests_total", "counter", "Outbound requests", samples
+    for field, (name, help_text) in HTTP_COUNTERS.items():
+        samples = [(labels, getattr(s, field)) for labels, s in endpoints]
+        yield f"sketyl_http_{name}_total", "counter", help_text, samples
+
+    samples = []
+    for labels, s in endpoints:
+        cumulative = itertools.accumulate(s.buckets)
+        for bound, count in zip(http.LATENCY_BUCKETS, cumulative):
+            samples.append((dict(labels, le=bound), count, "_bucket"))
+        samples.append((dict(labels, le="+Inf"), s.count, "_bucket"))
+        samples.append((labels, s.seconds, "_sum"))
+        samples.append((labels, s.count, "_count"))
+    yield "sketyl_http_request_seconds", "histogram", "Outbound latency", samples
+
+
+def breaker_families(breakers):
+    samples = [
+        ({"family": family}, int(b.state != b.CLOSED)) for family, b in breakers.items()
+    ]
+    yield "sketyl_http_circuit_open", "gauge", "Open or half open circuits", samples
+    samples = [({"family": family}, b.rejected) for family, b in breakers.items()]
+    yield "sketyl_http_circuit_rejected_total", "counter", "Fast failures", samples
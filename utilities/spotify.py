@@ -1,22 +1,27 @@
 from urllib.parse import urlencode
 from collections import Counter, defaultdict
+import asyncio
 import base64
+import logging
 import time
-import json
 
 from datetime import datetime, date
+from functools import partial
 
 from quart import request
-from utilities import utils, cache
+from utilities import utils, cache, codec, http
 from config import SPOTIFY
 
+log = logging.getLogger("sketyl.spotify")
+
 
 class CONSTANTS:
     WHITE_ICON = "https://cdn.discordapp.com/attachments/872338764276576266/927649624888602624/spotify_white.png"
     GREEN_ICON = "https://cdn.discordapp.com/attachments/872338764276576266/932399347289706556/spotify_green.png"
-    API_URL = "https://api.spotify.com/v1/"
-    AUTH_URL = "https://accounts.spotify.com/authorize"
-    TOKEN_URL = "https://accounts.spotify.com/api/token"
+    API_URL = getattr(SPOTIFY, "api_url", "https://api.spotify.com/v1/")
+    ACCOUNTS_URL = getattr(SPOTIFY, "accounts_url", "https://accounts.spotify.com/")
+    AUTH_URL = ACCOUNTS_URL + "authorize"
+    TOKEN_URL = ACCOUNTS_URL + "api/token"
     SCOPES = [  # Ask for bare minimum needed for functionality
         # Users
         "user-read-private",
@@ -39,14 +44,124 @@ class CONSTANTS:
     }
 
 
+# Audio features never change, so they're kept per track and shared by every user
+AUDIO_FEATURES = cache.LRUCache(max_entries=50000, max_bytes=64 * 1024 * 1024)
+
+
+async def _cached_audio_features(get, track_ids):
+    """get makes the Spotify GET, with the caller's credentials"""
+    fetch = partial(_request_audio_features, get)
+    return await cache.get_many(AUDIO_FEATURES, track_ids, fetch)
+
+
+async def _request_audio_features(get, track_ids):
+    features = []
+    for i in range(0, len(track_ids), 100):
+        query = urlencode({"ids": ",".join(track_ids[i : i + 100])})
+        batch = await get(CONSTANTS.API_URL + "audio-features?" + query)
+        features.extend(batch["audio_features"])
+
+    return features
+
+# How long each kind of Spotify data stays cached, by how fast it changes.
+# Audio features never change, they live in AUDIO_FEATURES without a ttl.
+POLICIES = {
+    # Full tracks with album and artist tracks, shared by every visitor
+    "catalog": cache.Policy(cache.Strategy.raw),
+    # Top tracks and artists shift daily
+    "top": cache.Policy(
+        cache.Strategy.stale,
+        ttl=3600,
+        jitter=0.1,
+        negative_ttl=600,
+        refresh_ahead=300,
+    ),
+    # Liked tracks, playlists and saved albums change when the user edits them
+    "library": cache.Policy(
+        cache.Strategy.stale, ttl=1800, jitter=0.1, negative_ttl=600
+    ),
+    # Recently played moves with every track
+    "recent": cache.Policy(cache.Strategy.stale, ttl=300, jitter=0.1),
+    # Changes every few seconds, nothing playing (204) is rechecked a bit later
+    "now_playing": cache.Policy(
+        cache.Strategy.timed, ttl=5, negative_ttl=10, persist=False
+    ),
+}
+
+
+class ClientToken:
+    """
+    The app's own token, shared by every anonymous request.
+    A background task replaces it refresh_ahead seconds before
+    it expires, so callers get it without waiting. Only when
+    that fell behind does a caller refresh, one at a time.
+    """
+
+    EXPIRY_MARGIN = 60  # Seconds before expiry a token stops being used
+
+    def __init__(self, request, *, refresh_ahead=300, retry_delay=5):
+        self.request = request
+        self.refresh_ahead = refresh_ahead
+        self.retry_delay = retry_delay
+
+        self.token = None
+        self.refreshes = 0
+
+        self.__lock = asyncio.Lock()
+        self.__task = None
+
+    def __valid(self):
+        if self.token is None:
+            return False
+        return self.token["expires_at"] - time.time() > self.EXPIRY_MARGIN
+
+    async def __refresh(self):
+        token = await self.request()
+        token["expires_at"] = int(time.time()) + token["expires_in"]
+        self.token = token
+        self.refreshes += 1
+
+    async def get(self):
+        if not self.__valid():
+            async with self.__lock:
+                if not self.__valid():  # Refreshed while we waited
+                    await self.__refresh()
+        return self.token["access_token"]
+
+    def start(self, *, loop=None):
+        if self.__task is None or self.__task.done():
+            loop = loop or asyncio.get_event_loop()
+            self.__task = loop.create_task(self.__run())
+        return self.__task
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            if self.token is not None:
+                due = self.token["expires_at"] - self.refresh_ahead
+                await asyncio.sleep(max(due - time.time(), 0))
+            try:
+                async with self.__lock:
+                    await self.__refresh()
+            except Exception:
+                log.exception("Refreshing the client credentials token failed")
+                await asyncio.sleep(self.retry_delay)
+
+
 class ClientCredentials:
     def __init__(self, app):
         self.app = app
         self.id = SPOTIFY.client_id
         self.secret = SPOTIFY.client_secret
 
-        self.token = None
-        app.loop.create_task(self.get_token())  # validate token
+        self.token = ClientToken(self.request_token)
+        self.token.start(loop=app.loop)
+
+        self.track_loader = cache.BatchLoader(self._request_tracks, 50)
 
     def _make_token_auth(self, client_id, client_secret):
         auth_header = base64.b64encode(
@@ -56,49 +171,42 @@ class ClientCredentials:
 
     async def get_track(self, track_id):
         """Get a track's info from its id"""
-        return await self.make_spotify_req(
-            CONSTANTS.API_URL + "tracks/{0}".format(track_id)
-        )
+        return await self.track_loader.load(track_id)
+
+    async def _request_tracks(self, track_ids):
+        query = urlencode({"ids": ",".join(track_ids)})
+        r = await self.make_spotify_req(CONSTANTS.API_URL + "tracks?" + query)
+        return r["tracks"]
 
     async def get_track_features(self, track_id):
-        return await self.make_spotify_req(
-            CONSTANTS.API_URL + "audio-features/{0}".format(track_id)
-        )
+        features = await self.get_tracks_features([track_id])
+        return features[0]
 
     async def get_tracks_features(self, track_ids):
-        features = []
-        while len(track_ids) > 0:
-            params = {"ids": ",".join(track_ids[:100])}
-            query = urlencode(params)
-            batch = await self.make_spotify_req(
-                CONSTANTS.API_URL + "audio-features?" + query
-            )
-            features.extend(batch["audio_features"])
-            del track_ids[:100]
-
-        return features
+        return await _cached_audio_features(self.make_spotify_req, track_ids)
 
-    @cache.cache(strategy=cache.Strategy.raw)
+    @cache.cache(policy=POLICIES["catalog"])
     async def get_full_track(self, track_id):
-        data = await self.get_track(track_id)
-        data["audio_features"] = await self.get_track_features(track_id)
-
-        album_tracks = data["album"]["tracks"] = await self.get_album_tracks(
-            data["album"]["id"]
+        # Responses are shared with http's ETag store, so this builds copies
+        track, track_features = await asyncio.gather(
+            self.get_track(track_id), self.get_track_features(track_id)
         )
+        album, artist = track["album"], track["artists"][0]
 
-        artist_tracks = data["artists"][0][
-            "top_tracks"
-        ] = await self.get_artist_top_tracks(data["artists"][0]["id"])
-
-        tracks_without_features = album_tracks + artist_tracks
-
-        features = await self.get_tracks_features(
-            [t["id"] for t in tracks_without_features]
+        album_tracks, artist_tracks = await asyncio.gather(
+            self.get_album_tracks(album["id"]),
+            self.get_artist_top_tracks(artist["id"]),
         )
-        for track, feat in zip(tracks_without_features, features):
-            track["audio_features"] = feat
-
+        related = album_tracks + artist_tracks
+        features = await self.get_tracks_features([t["id"] for t in related])
+        related = [dict(t, audio_features=f) for t, f in zip(related, features)]
+        album_tracks = related[: len(album_tracks)]
+        artist_tracks = related[len(album_tracks) :]
+
+        data = dict(track, audio_features=track_features)
+        data["album"] = dict(album, tracks=album_tracks)
+        data["artists"] = [dict(artist, top_tracks=artist_tracks)]
+        data["artists"].extend(track["artists"][1:])
         return Track(data)
 
     async def get_album_tracks(self, album_id):
@@ -136,7 +244,9 @@ class ClientCredentials:
 
     async def make_get(self, url, headers=None):
         """Makes a GET request and returns the results"""
-        return await self.app.http.get(url, headers=headers, res_method="json")
+        return await self.app.http.get(
+            url, headers=headers, res_method="json", etag_scope="client"
+        )
 
     async def make_post(self, url, payload, headers=None):
         """Makes a POST request and returns the results"""
@@ -145,20 +255,8 @@ class ClientCredentials:
         )
 
     async def get_token(self):
-        """Gets the token or creates a new one if expired"""
-        if self.token and not await self.check_token(self.token):
-            return self.token["access_token"]
-
-        token = await self.request_token()
-        if token:
-            token["expires_at"] = int(time.time()) + token["expires_in"]
-            self.token = token
-            return self.token["access_token"]
-
-    async def check_token(self, token):
-        """Checks a token is valid"""
-        now = int(time.time())
-        return token["expires_at"] - now < 60
+        """Gets the cached token, only waiting if it expired"""
+        return await self.token.get()
 
     async def request_token(self):
         """Obtains a token from Spotify and returns it"""
@@ -296,7 +394,7 @@ class Album(BaseUtils):
         self.artists = [Artist(artist) for artist in data["artists"]]
 
         self.raw = data
-        self.json = json.dumps(data)
+        self.json = codec.dumps(data)
 
         if data.get("tracks") or tracks:
             self.tracks = tracks or [
@@ -319,7 +417,7 @@ class Artist(BaseUtils):
         self.genres = data.get("genres", [])
 
         self.raw = data
-        self.json = json.dumps(data)
+        self.json = codec.dumps(data)
 
         self.index = index
 
@@ -348,7 +446,7 @@ class Track(BaseUtils):
         self.artists = [Artist(a) for a in data["artists"]]
 
         self.raw = data
-        self.json = json.dumps(data)
+        self.json = codec.dumps(data)
 
         self.features = data.get("audio_features")
         self.index = data.get("index")
@@ -376,7 +474,7 @@ class Playlist(BaseUtils):
         # ]
 
         self.raw = data
-        self.json = json.dumps(dict(data, rank=rank or 0))
+        self.json = codec.dumps(dict(data, rank=rank or 0))
 
         self.index = rank
 
@@ -399,6 +497,12 @@ class User:  # Current user's spotify instance
         self.client = app
         self.oauth = Oauth(app)
 
+        # Lookups made while rendering a page go out together
+        fetch = self._request_many
+        self.track_loader = cache.BatchLoader(partial(fetch, "tracks"), 50)
+        self.artist_loader = cache.BatchLoader(partial(fetch, "artists"), 50)
+        self.album_loader = cache.BatchLoader(partial(fetch, "albums"), 20)
+
     @staticmethod
     async def _get_user_id(app, token_info):
         token = token_info.get("access_token")
@@ -441,9 +545,14 @@ class User:  # Current user's spotify instance
 
     async def get(self, url):
         return await self.client.http.get(
-            url, headers=await self.auth(), res_method="json"
+            url, headers=await self.auth(), res_method="json", etag_scope=self.id
         )
 
+    async def _request_many(self, kind, ids):
+        query = urlencode({"ids": ",".join(ids)})
+        r = await self.get(CONSTANTS.API_URL + f"{kind}?" + query)
+        return r[kind]
+
     async def put(self, url, json=None, res_method=None):
         return await self.client.http.put(
             url, headers=await self.auth(), json=json, res_method=res_method
@@ -465,23 +574,18 @@ class User:  # Current user's spotify instance
 
     async def _format_tracks(self, tracks):
         tracks_ids = [track["id"] for track in tracks]
-        feats = await self.get_audio_features(tracks_ids)
+        try:
+            feats = await self.get_audio_features(tracks_ids)
+        except http.UNAVAILABLE:  # Features can wait
+            cache.degrade()
+            feats = [None] * len(tracks)
         func = lambda x, y: Track(dict(x, audio_features=y), quality="fast")
         return list(map(func, tracks, feats))
 
-    @cache.cache(strategy=cache.Strategy.timed)
     async def get_audio_features(self, track_ids):
-        features = []
-        while len(track_ids) > 0:
-            params = {"ids": ",".join(track_ids[:100])}
-            query = urlencode(params)
-            batch = await self.get(CONSTANTS.API_URL + "audio-features?" + query)
-            features.extend(batch["audio_features"])
-            del track_ids[:100]
+        return await _cached_audio_features(self.get, track_ids)
 
-        return features
-
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["library"])
     async def get_liked_tracks(self, tracks: int = 99):
         """
         Get the current users liked tracks.
@@ -503,7 +607,7 @@ class User:  # Current user's spotify instance
 
         return await self._format_tracks(liked_tracks)
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["recent"])
     async def get_recent_tracks(self, tracks: int = 50):
         """
         Get the current users recent tracks.
@@ -515,7 +619,7 @@ class User:  # Current user's spotify instance
         batch = await self.get(CONSTANTS.API_URL + "me/player/recently-played?" + query)
         return await self._format_tracks([item["track"] for item in batch["items"]])
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["top"])
     async def get_top_tracks(self, tracks: int = 99, time_range="short_term"):
         """
         Get the current users top tracks.
@@ -539,7 +643,7 @@ class User:  # Current user's spotify instance
 
         return await self._format_tracks(top_tracks)
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["top"])
     async def get_top_artists(self, artists: int = 99, time_range="short_term"):
         """
         Get the current users top artists.
@@ -565,7 +669,7 @@ class User:  # Current user's spotify instance
 
         return top_artists
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["top"])
     async def get_decades(self, time_range="short_term"):
         data = await self.get_top_tracks(time_range=time_range)
         decade = lambda date: (int(date.split("-")[0]) // 10) * 10
@@ -575,7 +679,7 @@ class User:  # Current user's spotify instance
 
         return {str(decade) + "s": tracks for decade, tracks in sorted(decades.items())}
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["library"])
     async def get_playlists(self, playlists: int = 100):
         """Get a user's owned and followed playlists"""
         _playlists = []
@@ -592,7 +696,7 @@ class User:  # Current user's spotify instance
 
         return _playlists
 
-    @cache.cache(strategy=cache.Strategy.timed)
+    @cache.cache(policy=POLICIES["library"])
     async def get_saved_albums(self, albums: int = 100):
         """Get a user's saved albums"""
         _albums = []
@@ -631,18 +735,10 @@ class User:  # Current user's spotify instance
         return Counter(genres)
 
     async def get_album(self, album_id):
-        return await self.get(CONSTANTS.API_URL + f"albums/{album_id}")
+        return await self.album_loader.load(album_id)
 
     async def get_albums(self, album_ids):
-        albums = []
-        while len(album_ids):
-
-            query = urlencode({"ids": ",".join(album_ids[:20])})
-            batch = await self.get(CONSTANTS.API_URL + f"albums?" + query)
-            albums.extend(batch["albums"])
-            del album_ids[:20]
-
-        return albums
+        return await asyncio.gather(*map(self.album_loader.load, album_ids))
 
     async def get_album_tracks(self, album_id, limit=50, *, offset=0):
         params = {"limit": limit, "offset": offset}
@@ -694,23 +790,26 @@ class User:  # Current user's spotify instance
         friends = your_owners.intersection(their_owners)
         return friends
 
+    @cache.cache(policy=POLICIES["now_playing"])
     async def now_playing(self):
         return await self.get(CONSTANTS.API_URL + f"me/player/currently-playing")
 
     async def get_track(self, track_id):
-        return await self.get(CONSTANTS.API_URL + f"tracks/{track_id}")
+        return await self.track_loader.load(track_id)
 
     async def get_track_features(self, track_id):
-        return await self.get(CONSTANTS.API_URL + f"audio-features/{track_id}")
+        features = await self.get_audio_features([track_id])
+        return features[0]
 
     async def get_full_track(self, track_id):
         """Get track with audio features"""
-        track = await self.get_track(track_id)
-        track["audio_features"] = await self.get_track_features(track_id)
-        return track
+        track, features = await asyncio.gather(
+            self.get_track(track_id), self.get_track_features(track_id)
+        )
+        return dict(track, audio_features=features)  # track is shared, copy it
 
     async def get_artist(self, id):
-        return await self.get(CONSTANTS.API_URL + f"artists/{id}")
+        return await self.artist_loader.load(id)
 
     async def get_user(self, user_id):
         return await self.get(CONSTANTS.API_URL + f"users/{user_id}")
@@ -754,7 +853,7 @@ class User:  # Current user's spotify instance
         }
         return await self.client.http.post(
             CONSTANTS.API_URL + f"users/{spotify_id}/playlists",
-            data=json.dumps(data),
+            data=codec.dumps(data),
             headers=await self.auth(),
             res_method="json",
         )
@@ -767,7 +866,7 @@ class User:  # Current user's spotify instance
                 data["position"] = position
             snapshot = await self.client.http.post(
                 CONSTANTS.API_URL + f"playlists/{playlist_id}/tracks",
-                data=json.dumps(data),
+                data=codec.dumps(data),
                 headers=await self.auth(),
                 res_method="json",
             )
@@ -866,7 +965,7 @@ class Formatting:
                     ],
                     "duration": utils.parse_duration(track["duration_ms"] // 1000),
                     "album": track["album"]["name"],
-                    "json": json.dumps(
+                    "json": codec.dumps(
                         dict(track, rank=index, audio_features=features)
                     ),
                 }
@@ -913,7 +1012,7 @@ class Formatting:
                         item["track"]["duration_ms"] // 1000
                     ),
                     "album": item["track"]["album"]["name"],
-                    "json": json.dumps(
+                    "json": codec.dumps(
                         dict(item["track"], rank=index, audio_features=features)
                     ),
                 }
@@ -941,7 +1040,7 @@ class Formatting:
                         item["track"]["duration_ms"] // 1000
                     ),
                     "album": item["track"]["album"]["name"],
-                    "json": json.dumps(
+                    "json": codec.dumps(
                         dict(item["track"], rank=index, audio_features=features)
                     ),
                 }
@@ -957,7 +1056,7 @@ class Formatting:
                 "index": index,
                 "image": self.get_image(artist),
                 "name": artist["name"],
-                "json": json.dumps(dict(artist, rank=index)),
+                "json": codec.dumps(dict(artist, rank=index)),
             }
             for index, artist in enumerate(data, start=1)
         ]
@@ -1002,7 +1101,7 @@ class Formatting:
                 if playlist["public"]
                 else "Private",
                 "tracks": playlist["tracks"]["total"],
-                "json": json.dumps(dict(playlist, rank=index)),
+                "json": codec.dumps(dict(playlist, rank=index)),
             }
             for index, playlist in enumerate(data, start=1)
         ]
@@ -1020,7 +1119,7 @@ class Formatting:
                 ],
                 "release": self.release_date(album["album"]["release_date"]),
                 "tracks": album["album"]["total_tracks"],
-                "json": json.dumps(dict(album, rank=index)),
+                "json": codec.dumps(dict(album, rank=index)),
             }
             for index, album in enumerate(data, start=1)
         ]
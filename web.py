@@ -1,5 +1,4 @@
 import os
-import json
 import asyncio
 import aiohttp
 import asyncpg
@@ -9,6 +8,7 @@ import secrets
 from datetime import datetime, timedelta
 from functools import wraps
 from logging.handlers import RotatingFileHandler
+from urllib.parse import urlsplit
 
 from quart import (
     Quart,
@@ -23,7 +23,20 @@ from quart import (
 
 
 import config
-from utilities import http, spotify, constants, utils, database
+import config_example
+from utilities import http, spotify, constants, utils, database, cache, metrics, codec
+
+
+# Sections and settings added since a config.py was written use the example's
+for _name in ("CACHE", "HTTP", "METRICS"):
+    _defaults = getattr(config_example, _name)
+    _section = getattr(config, _name, None)
+    if _section is None:
+        setattr(config, _name, _defaults)
+        continue
+    for _key, _value in vars(_defaults).items():
+        if not _key.startswith("_") and not hasattr(_section, _key):
+            setattr(_section, _key, _value)
 
 
 # Set up our website logger
@@ -61,6 +74,17 @@ class Sketyl(Quart):
         self.owner = "x7vjqlqi759vsiemiqh9ekdoa"  # Hecate946
 
         self.client = spotify.ClientCredentials(self)
+        cache.start_janitors(loop=self.loop)  # Purge expired entries off-request
+        cache.CACHE.resize(config.CACHE.max_entries, config.CACHE.max_bytes)
+        cache.BUDGET.resize(config.CACHE.max_memory)
+        cache.REFRESHER.rate = config.CACHE.refresh_rate
+        cache.REFRESHER.start(loop=self.loop)
+        if config.CACHE.disk_path:  # Survive restarts without a cold start
+            cache.enable_disk_tier(
+                config.CACHE.disk_path,
+                max_bytes=config.CACHE.disk_max_bytes,
+                loop=self.loop,
+            )
 
         self.jinja_env.globals.update(
             readable_audio_features=utils.readable_audio_features
@@ -69,17 +93,66 @@ class Sketyl(Quart):
     def run(self):
         super().run(host="0.0.0.0", port=3000, loop=self.loop)
 
+    def make_session(self, limit, limit_per_host=0):
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=config.HTTP.keepalive_timeout,
+            ttl_dns_cache=config.HTTP.dns_cache_ttl,
+        )
+        return aiohttp.ClientSession(
+            loop=self.loop, connector=connector, timeout=self.timeout
+        )
+
     async def set_sessions(self):
+        self.timeout = aiohttp.ClientTimeout(
+            connect=config.HTTP.connect_timeout, sock_read=config.HTTP.read_timeout
+        )
         if not hasattr(self, "session"):
-            self.session = aiohttp.ClientSession(loop=self.loop)
+            self.session = self.make_session(
+                config.HTTP.max_connections, config.HTTP.max_connections_per_host
+            )
+        if not hasattr(self, "auth_session"):  # Token refreshes skip the API queue
+            self.auth_session = self.make_session(config.HTTP.auth_max_connections)
 
         if not hasattr(self, "http"):
-            self.http = http.Utils(self.session)
+            accounts = urlsplit(spotify.CONSTANTS.TOKEN_URL).netloc
+            self.http = http.Utils(
+                self.session,
+                sessions={accounts: self.auth_session},
+                timeout=self.timeout,
+                rate=config.HTTP.rate_limit,
+                burst=config.HTTP.rate_burst,
+                max_retries=config.HTTP.max_retries,
+                request_deadline=config.HTTP.request_deadline,
+                slow_seconds=config.HTTP.slow_request,
+                cassette=self.make_cassette(),
+                breaker_threshold=config.HTTP.breaker_threshold,
+                breaker_recovery=config.HTTP.breaker_recovery,
+            )
+
+    def make_cassette(self):
+        if config.HTTP.cassette:  # Run the Spotify layer offline
+            return http.Cassette(
+                config.HTTP.cassette,
+                config.HTTP.cassette_mode,
+                latency=config.HTTP.cassette_latency,
+            )
 
 
 app = Sketyl(__name__)
 
 
+@app.after_serving
+async def shutdown():
+    await cache.close_disk_tier()  # Flush pending writes
+    app.client.token.stop()
+    await app.session.close()
+    await app.auth_session.close()
+    if app.http.cassette:
+        app.http.cassette.close()
+
+
 async def get_user():
     user_id = request.cookies.get("user_id")
     if user_id:
@@ -115,14 +188,46 @@ def login_required():
     return decorator
 
 
+def time_budget(seconds=None):
+    """Spotify calls made for the route share seconds, config.HTTP.page_budget"""
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with http.deadline(seconds or config.HTTP.page_budget):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@app.errorhandler(http.DeadlineExceeded)
+async def deadline_exceeded(error):
+    return "Spotify is taking too long, please try again in a moment.", 504
+
+
+@app.errorhandler(http.UpstreamError)
+async def upstream_error(error):
+    return "Spotify is having trouble right now, please try again later.", 502
+
+
+@app.errorhandler(http.RateLimited)
+async def rate_limited(error):
+    retry_after = str(max(1, round(error.retry_after)))
+    message = "Spotify is busy, please try again shortly."
+    return message, 503, {"Retry-After": retry_after}
+
+
 async def _tasked_requests(user):
-    await user.get_decades()
-    await user.get_top_genres()
-    for span in spotify.CONSTANTS.TIME_RANGE_MAP.keys():
-        await user.get_top_tracks(time_range=span)
-        await user.get_top_artists(time_range=span)
-    await user.get_recent_tracks()
-    await user.get_liked_tracks()
+    with http.deadline(None):  # Started from a route, but not bound by its budget
+        await user.get_decades()
+        await user.get_top_genres()
+        for span in spotify.CONSTANTS.TIME_RANGE_MAP.keys():
+            await user.get_top_tracks(time_range=span)
+            await user.get_top_artists(time_range=span)
+        await user.get_recent_tracks()
+        await user.get_liked_tracks()
 
 
 @app.before_first_request
@@ -133,6 +238,7 @@ async def speed_loader():
 
 
 @app.route("/")
+@time_budget()
 async def home():
     user = await get_user()
     if not user:
@@ -171,8 +277,11 @@ async def home():
                     "home.html", title="Featured Song", track=track
                 )
 
-    decades = await user.get_decades(time_range=zone)
-    genres = await user.get_top_genres(time_range=zone)
+    try:
+        decades = await user.get_decades(time_range=zone)
+        genres = await user.get_top_genres(time_range=zone)
+    except http.DeadlineExceeded:  # Render the track without the charts
+        decades, genres = {}, {}
 
     return await render_template(
         "main.html",
@@ -181,13 +290,14 @@ async def home():
         genres=list(genres.keys())[:10],
         profile="https://sketyl.com/profile/?id=" + user.id,
         decades=decades,
-        labels=json.dumps(list(decades.keys())),
-        data=json.dumps([len(decades[decade]) for decade in decades]),
-        colors=json.dumps(constants.colors[: len(decades.keys())]),
+        labels=codec.dumps(list(decades.keys())),
+        data=codec.dumps([len(decades[decade]) for decade in decades]),
+        colors=codec.dumps(constants.colors[: len(decades.keys())]),
     )
 
 
 @app.route("/profile/")
+@time_budget()
 async def profile():
     user_id = request.args.get("id")
     user = await spotify.User.from_id(user_id, app)
@@ -210,9 +320,9 @@ async def profile():
         track=track,
         genres=list(genres.keys())[:10],
         decades=decades,
-        labels=json.dumps(list(decades.keys())),
-        data=json.dumps([len(decades[decade]) for decade in decades]),
-        colors=json.dumps(constants.colors[: len(decades.keys())]),
+        labels=codec.dumps(list(decades.keys())),
+        data=codec.dumps([len(decades[decade]) for decade in decades]),
+        colors=codec.dumps(constants.colors[: len(decades.keys())]),
     )
 
 
@@ -265,6 +375,8 @@ async def spotify_disconnect():
         return "You are not logged in"
 
     await app.db.delete_user(user_id)
+    cache.invalidate(user=user_id)
+    app.http.forget(user_id)  # Their ETag'd responses
     response = await make_response(redirect(url_for("home")))
     response.set_cookie("user_id", "", expires=0)
     app.current_users.pop(user_id, None)
@@ -272,6 +384,7 @@ async def spotify_disconnect():
 
 
 @app.route("/spotify/recent/")
+@time_budget()
 @login_required()
 async def spotify_recent():
     user = await get_user()
@@ -281,12 +394,13 @@ async def spotify_recent():
         "spotify/tracks.html",
         type="recent",
         tracks=tracks,
-        track_ids=json.dumps([track.id for track in tracks]),
+        track_ids=codec.dumps([track.id for track in tracks]),
         caption="Recent Tracks",
     )
 
 
 @app.route("/spotify/liked/")
+@time_budget()
 @login_required()
 async def spotify_liked():
     user = await get_user()
@@ -296,12 +410,13 @@ async def spotify_liked():
         "spotify/tracks.html",
         type="liked",
         tracks=tracks,
-        track_ids=json.dumps([track.id for track in tracks]),
+        track_ids=codec.dumps([track.id for track in tracks]),
         caption="Liked Tracks",
     )
 
 
 @app.route("/spotify/top_tracks/")
+@time_budget()
 @login_required()
 async def spotify_top_tracks():
     span = request.args.get("time_range", "short_term")
@@ -312,12 +427,13 @@ async def spotify_top_tracks():
         "spotify/tracks.html",
         type="top",
         tracks=tracks,
-        track_ids=json.dumps([track.id for track in tracks]),
+        track_ids=codec.dumps([track.id for track in tracks]),
         caption="Top Tracks",
     )
 
 
 @app.route("/spotify/top_artists/")
+@time_budget()
 @login_required()
 async def spotify_top_artists():
     span = request.args.get("time_range", "short_term")
@@ -333,6 +449,7 @@ async def spotify_top_artists():
 
 
 @app.route("/spotify/decades")
+@time_budget()
 async def spotify_decades():
     user_id = request.cookies.get("user_id")
 
@@ -354,13 +471,14 @@ async def spotify_decades():
     return await render_template(
         "/spotify/charts.html",
         decades=decades,
-        labels=json.dumps(list(decades.keys())),
-        data=json.dumps([len(decades[decade]["tracks"]) for decade in decades]),
-        colors=json.dumps(constants.colors[: len(decades.keys())]),
+        labels=codec.dumps(list(decades.keys())),
+        data=codec.dumps([len(decades[decade]["tracks"]) for decade in decades]),
+        colors=codec.dumps(constants.colors[: len(decades.keys())]),
     )
 
 
 @app.route("/spotify/albums")
+@time_budget()
 async def spotify_albums():
     user_id = request.cookies.get("user_id")
 
@@ -386,6 +504,7 @@ async def spotify_albums():
 
 
 @app.route("/spotify/albums/<album_id>")
+@time_budget()
 async def albums(album_id):
     user_id = request.cookies.get("user_id")
 
@@ -416,6 +535,7 @@ async def albums(album_id):
 
 
 @app.route("/spotify/playlists")
+@time_budget()
 @login_required()
 async def spotify_playlists():
     user = await get_user()
@@ -432,6 +552,7 @@ async def spotify_playlists():
 
 
 @app.route("/spotify/playlists/<playlist_id>")
+@time_budget()
 @login_required()
 async def playlists(playlist_id):
     user = await get_user()
@@ -462,6 +583,33 @@ async def g():
 # INTERNALS
 
 
+@app.route("/_metrics")
+async def _metrics():
+    """Cache and HTTP counters for scrapers, as JSON or ?format=prometheus"""
+    token = config.METRICS.token  # Not configured, nobody can read them
+    auth = request.headers.get("Authorization", "")
+    if not token or not secrets.compare_digest(auth, f"Bearer {token}"):
+        return "Forbidden", 403
+
+    stats = cache.stats()
+    if request.args.get("format") == "prometheus":
+        body = metrics.render(
+            [
+                *metrics.cache_families(stats),
+                *metrics.http_families(app.http.requests),
+                *metrics.breaker_families(app.http.breakers),
+            ]
+        )
+        return body, 200, {"Content-Type": "text/plain; version=0.0.4"}
+    return jsonify(
+        caches=stats,
+        disk=cache.disk_stats(),
+        memory=cache.memory_stats(),
+        refresh=cache.REFRESHER.stats(),
+        http=app.http.stats(),
+    )
+
+
 @app.route("/spotify/_create_playlist", methods=["POST"])
 async def _spotify_create_playlist():
     """Create a playlist from JSON data"""
@@ -484,11 +632,13 @@ async def _spotify_create_playlist():
 
     playlist = await user.create_playlist(name, desc=desc)
     await user.add_to_playlist(playlist["id"], track_uris)
+    user.get_playlists.invalidate_tags(user=user.id)
 
     return jsonify(response=f"Successfully created playlist: {name}")
 
 
 @app.route("/spotify/_genre_recommendations", methods=["GET"])
+@time_budget()
 async def _spotify_genre_recommendations():
     user_id = request.cookies.get("user_id")
     if not user_id: